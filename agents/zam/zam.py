@@ -25,20 +25,24 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import bisect
+import functools
 import gettext
+import inspect
+import itertools
+import json
 import os
+import random
 import re
-import shutil
 import stat
-import subprocess
+import threading
+import time
 import zoe
-from configparser import ConfigParser
+from collections import deque
 from io import StringIO
 from os import environ as env
 from os.path import join as path
-from semantic_version import Version
-from zoe.deco import Agent, Message
-from zoe.models.users import Users
+from zoe.deco import Agent, Message, Timed
 
 gettext.install("zam")
 
@@ -46,6 +50,13 @@ ZCONF_PATH = path(env["ZOE_HOME"], "etc", "zoe.conf")
 ZAM_TEMP = path(env["ZOE_VAR"], "zam")
 ZAM_LIST = path(env["ZOE_HOME"], "etc", "zam", "list")
 ZAM_INFO = path(env["ZOE_HOME"], "etc", "zam", "info")
+ZAM_REGISTRY = path(env["ZOE_HOME"], "etc", "zam", "registry")
+ZAM_SETTINGS = path(env["ZOE_HOME"], "etc", "zam", "zam.conf")
+ZAM_STAGE = path(ZAM_TEMP, "staged")
+ZAM_PROFILES = path(ZAM_TEMP, "profiles")
+ZAM_JOURNAL = path(ZAM_TEMP, "journal")
+ZAM_STATE = path(ZAM_TEMP, "state.json")
+ZAM_OPS = path(ZAM_TEMP, "ops.json")
 ZOE_LOCALE = env["ZOE_LOCALE"] or "en"
 LOCALEDIR = path(env["ZOE_HOME"], "locale")
 
@@ -55,16 +66,154 @@ if not os.path.isfile(ZOE_LAUNCHER):
     # Fallback to old script
     ZOE_LAUNCHER = path(env["ZOE_HOME"], "zoe.sh")
 
+# Number of lines shown per page in status and search reports
+PAGE_SIZE = 10
+
+# File hashing for integrity checks: threads used, size of the chunks read
+# and size from which files are mapped into memory instead
+HASH_WORKERS = min(8, (os.cpu_count() or 1) * 2)
+HASH_CHUNK = 1024 * 1024
+HASH_MMAP_SIZE = 16 * 1024 * 1024
+
+# Number of files hashed at once when writing a manifest
+HASH_BATCH = 512
+
+# Copying of agent files: threads used and number of copies queued at once
+COPY_WORKERS = min(8, (os.cpu_count() or 1) * 2)
+COPY_QUEUE = COPY_WORKERS * 4
+
+# ioctl used to clone files (reflinks) in copy on write filesystems
+FICLONE = 0x40049409
+
+# Watched agents: seconds between checks of their local sources and seconds
+# without changes before they are synced
+WATCH_INTERVAL = 2
+WATCH_SETTLE = 1
+
+# Seconds between checks of whether the running agents should be sampled
+USAGE_TICK = 10
+
+# Directories in var/zam that are not removed by clean()
+ZAM_RESERVED = ["staged", "profiles", "journal", "state.json", "ops.json"]
+
+# Default values for the settings in etc/zam/zam.conf
+SETTINGS_DEFAULTS = {
+    "prefetch": {
+        # Fetch the sources of installed agents in the background
+        "enabled": "0",
+        # Seconds between runs, randomly moved up to 'jitter' seconds
+        "interval": "3600",
+        "jitter": "300",
+        # Agents fetched at the same time
+        "workers": "2",
+        # Skip the run if the load average per CPU is higher than this
+        "max_load": "0.5",
+        # Niceness of the git processes
+        "nice": "19",
+        # Download limit in KB/s (requires trickle, 0 means no limit)
+        "bandwidth": "0"
+    },
+    "update-all": {
+        # Daily maintenance window in which all the agents are updated,
+        # such as 03:00-05:00 (empty to disable)
+        "window": "",
+        # Agents fetched and updated at the same time
+        "workers": "4",
+        # Agents restarted at the same time
+        "wave": "5",
+        # Seconds to wait before checking the restarted agents
+        "delay": "30"
+    },
+    "registry": {
+        # Directory with mirrors or checkouts of agents used to build the
+        # registry when no path is given
+        "mirrors": ""
+    },
+    "usage": {
+        # Seconds between samples of the CPU, memory and open files of the
+        # running agents (0 to disable)
+        "interval": "60",
+        # Samples kept for each agent
+        "samples": "60",
+        # File in which the metrics are written after each sample, in the
+        # Prometheus text format (empty to disable)
+        "metrics": ""
+    }
+}
+
+
+def profiled(f):
+    """ Allow profiling a message handler on demand (see the profile tag).
+
+        When no profiling session is active, the handler is called directly.
+        The signature of the handler is kept, as zoe.deco relies on it.
+    """
+    def wrapper(self, *args, **kwargs):
+        if self.profiler is None:
+            return f(self, *args, **kwargs)
+
+        return self.profile_call(f, *args, **kwargs)
+
+    functools.update_wrapper(wrapper, f)
+    wrapper.__signature__ = inspect.signature(f)
+
+    return wrapper
+
 
 @Agent(name="zam")
 class AgentManager:
 
+    def __init__(self):
+        # Cached agent index, rebuilt only when the list or zoe.conf change
+        self.index = {}
+        self.index_key = None
+        # Result of the last operation performed on each agent
+        self.ops = {}
+        self.ops_lock = threading.Lock()
+        # Prefetched sources ready to be applied: name -> (source, version)
+        self.staged = {}
+        self.stage_locks = {}
+        self.stage_lock = threading.Lock()
+        self.next_prefetch = 0
+        self.prefetcher = None
+        # Staged restarts of update-all
+        self.rollout = None
+        self.last_window = None
+        # Registry of available agents and its index of (token, name) pairs
+        self.registry = {}
+        self.registry_tokens = []
+        self.registry_key = None
+        # Active profiling session (None when not profiling)
+        self.profiler = None
+        self.profiler_lock = threading.Lock()
+        # Translations by locale and the one currently installed
+        self.translations = {}
+        self.locale = None
+        # Agents with a local source synced when it changes: name -> watch
+        self.watches = {}
+        # Disk usage of the agent files by agent, see disk_usage()
+        self.disk = {}
+        # Samples of the running agents: name -> pid, CPU time and samples
+        self.usage_samples = {}
+        self.next_sample = 0
+
+        # Reuse the indexes of the previous run and build whatever changed
+        # in the background, so that registration is not delayed
+        self.load_state()
+
+        # Finish the operations interrupted by the last stop
+        self.recover_transactions()
+
+        threading.Thread(target=self.warm_up, daemon=True).start()
+
     @Message(tags=["add"])
+    @profiled
     def add(self, parser):
         """ Add an agent to the list.
 
             name*   - unique name of the agent
-            source* - git source from which the agent is fetched
+            source* - git source or local directory from which the agent
+                is fetched
             sender  - sender of the message
             src     - channel from which the message was obtained
         """
@@ -88,15 +237,36 @@ class AgentManager:
         self.add_to_list(name, source, alist, False)
 
     @Message(tags=["clean"])
+    @profiled
     def clean(self):
-        """ Clean the temp data stored in var/zam. """
+        """ Clean the temp data stored in var/zam.
+
+            Prefetched sources are kept.
+        """
+        import shutil
+
         try:
-            shutil.rmtree(ZAM_TEMP)
+            temp = os.listdir(ZAM_TEMP)
         except:
             # Nothing to remove?
-            pass
+            return
+
+        for d in [t for t in temp if t not in ZAM_RESERVED]:
+            target = path(ZAM_TEMP, d)
+            try:
+                if os.path.islink(target):
+                    # Local source
+                    os.remove(target)
+                else:
+                    shutil.rmtree(target)
+            except NotADirectoryError:
+                os.remove(path(ZAM_TEMP, d))
+            except:
+                # Nothing to remove?
+                pass
 
     @Message(tags=["forget"])
+    @profiled
     def forget(self, parser):
         """ Remove an agent from the agent list.
 
@@ -129,20 +299,177 @@ class AgentManager:
             alist.remove_section(name)
             self.write_list(alist)
 
+        self.discard_staged(name)
+
         self.logger.info("'%s' removed from list" % name)
 
         return self.feedback(
             _("Removed agent '%s' from agent list") % name, sender, src)
 
+    @Message(tags=["gc"])
+    @profiled
+    def gc(self, parser):
+        """ Find (and optionally remove) leftovers of failed operations.
+
+            This includes files in agents/, cmdproc/ and mailproc/ that
+            belong to agents in the list that are not installed (they have
+            no file list), .pid files of processes that are no longer
+            running, zoe.conf sections and topic entries of agents in the
+            list that are not installed and temporary data in var/zam.
+
+            Files of installed agents that do not appear in their file list
+            (other than __pycache__) are only reported, as agents may create
+            files while running.
+
+            Agents that are not in the list (such as Zoe's own agents) are
+            never touched.
+
+            apply   - if '1', remove the leftovers instead of reporting them
+            sender  - sender of the message
+            src     - channel from which the message was obtained
+        """
+        apply, sender, src = self.multiparse(
+            parser, ['apply', 'sender', 'src'])
+
+        self.set_locale(sender)
+
+        if not self.has_permissions(sender):
+            self.logger.info("%s tried to collect garbage" % sender)
+            return self.feedback(_("You don't have permissions to do that"),
+                sender, src)
+
+        alist = self.read_list()
+        known = set(alist.sections())
+        owned = self.owned_files()
+
+        # Orphaned files, and unowned files of installed agents (kept)
+        orphans = []
+        unowned = []
+
+        def found(agent, f):
+            if f in owned or "__pycache__" in f.split(os.sep):
+                return
+
+            if os.path.isfile(path(ZAM_INFO, agent + ".list")):
+                unowned.append(f)
+            else:
+                orphans.append(f)
+
+        agents_dir = path(env["ZOE_HOME"], "agents")
+        for agent in [a for a in known if os.path.isdir(path(agents_dir, a))]:
+            for f in self.scan_files(path("agents", agent)):
+                found(agent, f)
+
+        for d in ["cmdproc", "mailproc"]:
+            for f in self.scan_files(d):
+                agent = os.path.basename(f).split(".")[0]
+                if agent in known:
+                    found(agent, f)
+
+        # Stale .pid files, those that cannot be read may still be being
+        # written by the launcher (only reported)
+        pids = self.pid_files()
+        stale = [agent for agent, (pid, started) in pids.items()
+            if pid is not None and not self.alive(pid)]
+        unknown = [agent for agent, (pid, started) in pids.items()
+            if pid is None]
+
+        # Dangling zoe.conf entries
+        def dangling(agent):
+            return agent in known and not self.installed(agent, alist)
+
+        zconf = self.read_conf()
+        entries = []
+        for sec in zconf.sections():
+            if sec.startswith("agent ") and dangling(sec[len("agent "):]):
+                entries.append(sec)
+                zconf.remove_section(sec)
+
+            elif sec.startswith("topic "):
+                topic_agents = zconf[sec].get("agents", "").split()
+                for agent in [a for a in topic_agents if dangling(a)]:
+                    entries.append("%s: %s" % (sec, agent))
+                    topic_agents.remove(agent)
+
+                if not topic_agents:
+                    zconf.remove_section(sec)
+                else:
+                    zconf[sec]["agents"] = " ".join(topic_agents)
+
+        # Temporary data
+        try:
+            temp = [path("var", "zam", d) for d in os.listdir(ZAM_TEMP)
+                if d not in ZAM_RESERVED]
+        except OSError:
+            temp = []
+
+        counts = {
+            "orphans": len(orphans),
+            "pids": len(stale),
+            "conf": len(entries),
+            "temp": len(temp)
+        }
+
+        if apply == "1":
+            for f in orphans:
+                self.logger.debug("Removing %s" % f)
+                self.remove_file(path(env["ZOE_HOME"], f))
+
+            for agent in stale:
+                self.logger.debug("Removing stale pid file of '%s'" % agent)
+                try:
+                    os.remove(path(env["ZOE_VAR"], agent + ".pid"))
+                except OSError:
+                    pass
+
+            if entries:
+                self.write_conf(zconf)
+
+            self.clean()
+
+            self.logger.info("Removed %(orphans)d orphaned files, %(pids)d "
+                "stale pid files, %(conf)d zoe.conf entries and %(temp)d "
+                "temporary directories" % counts)
+
+            msg = _("Removed %(orphans)d orphaned files, %(pids)d stale pid "
+                "files, %(conf)d dangling zoe.conf entries and %(temp)d "
+                "temporary directories") % counts
+
+        else:
+            msg = _("Found %(orphans)d orphaned files, %(pids)d stale pid "
+                "files, %(conf)d dangling zoe.conf entries and %(temp)d "
+                "temporary directories") % counts
+
+        report = [msg]
+        report += ["  " + f for f in orphans + temp]
+        report += ["  " + path("var", a + ".pid") for a in stale]
+        report += ["  zoe.conf [%s]" % e for e in entries]
+
+        if unowned:
+            report.append(_("%d files of installed agents are not in their "
+                "file list (not removed)") % len(unowned))
+            report += ["  " + f for f in unowned]
+
+        if unknown:
+            report.append(_("%d pid files could not be read (not removed)")
+                % len(unknown))
+            report += ["  " + path("var", a + ".pid") for a in unknown]
+
+        return self.feedback("\n".join(report), sender, src)
+
     @Message(tags=["install"])
+    @profiled
     def install(self, parser):
         """ Install an agent from source.
 
             name*   - unique name of the agent
-            source* - git source from which the agent is fetched
+            source* - git source or local directory from which the agent
+                is fetched
             sender  - sender of the message
             src     - channel from which the message was obtained
         """
+        import subprocess
+
         name, source, sender, src = self.multiparse(
             parser, ['name', 'source', 'sender', 'src'])
 
@@ -153,6 +480,9 @@ class AgentManager:
             return self.feedback(_("You don't have permissions to do that"),
                 sender, src)
 
+        # Finish any interrupted operation on the agent first
+        self.recover_transactions(name)
+
         alist = self.read_list()
 
         if self.installed(name, alist):
@@ -161,6 +491,10 @@ class AgentManager:
                 _("Agent '%s' is already installed") % name, sender, src)
 
         if name not in alist.sections():
+            if not source:
+                # Look for the agent in the registry
+                source = self.registry_index()[0].get(name, {}).get("source")
+
             if not source:
                 self.logger.debug("Source for '%s' not found" % name)
                 return self.feedback(_("Source not found"), sender, src)
@@ -177,6 +511,7 @@ class AgentManager:
                 alist[name]["source"])
 
             self.clean()
+            self.record(name, "install", "fetch failed")
             return self.feedback(_("Could not fetch source"), sender, src)
 
         a_info = self.parse_info(path(temp, "zam", "info"));
@@ -184,6 +519,8 @@ class AgentManager:
         # Version is mandatory!
         if not a_info["version"]:
             self.logger.info("Missing version information")
+            self.record(name, "install", "missing version")
+            self.clean()
 
             return self.feedback(
                 _("Missing version in info file for '%s'") % name, sender, src)
@@ -191,102 +528,98 @@ class AgentManager:
         # PREINSTALL
         preinst = path(temp, "zam", "preinst")
         if os.path.isfile(preinst):
-            st = os.stat(preinst)
-            os.chmod(preinst, st.st_mode | stat.S_IEXEC)
-            proc = subprocess.call([preinst, ])
+            proc = subprocess.call([self.hook_script(name, preinst), ])
 
             self.logger.debug("Ran preinst script, got code %i" % proc)
 
         # INSTALL
-        # Generate list of source files
-        file_list = self.move_files(name)
-
-        # Save agent file list
-        with open(path(ZAM_INFO, name + ".list"), "w+") as dfile:
-            for f in file_list:
-                dfile.write("%s\n" % f)
-
-        # Make script executable
-        #
-        # There may be cases where an agent is only formed by natural
-        # language files, so this key may not be present.
-        if a_info["script"]:
-            script = path(env["ZOE_HOME"], "agents",
-                name, a_info["script"])
-            st = os.stat(script)
-            os.chmod(script, st.st_mode | stat.S_IEXEC)
-
-        # Make cmdproc and mailproc scripts executable
-        for f in [cf for cf in file_list if cf.startswith("cmdproc") or
-                cf.startswith("mailproc")]:
-            df = path(env["ZOE_HOME"], f)
-            st = os.stat(df)
-            os.chmod(df, st.st_mode | stat.S_IEXEC)
-
-        # Add agent to the zoe.conf file
-        zconf = self.read_conf()
-
-        ports = []
-        for sec in zconf.sections():
-            if "port" in zconf[sec]:
-                ports.append(int(zconf[sec]["port"]))
-        ports = sorted(ports)
+        # Nothing changes in ZOE_HOME until the transaction is committed
+        txn = self.begin_transaction(name, "install")
 
-        if not ports:
-            ports.append(env["ZOE_SERVER_PORT"])
-        free_port = ports[0]
-        while free_port in ports:
-            free_port += 1
-
-        zconf.add_section("agent " + name)
-        zconf["agent " + name]["port"] = str(free_port)
-
-        # Topics are optional
-        if a_info["topics"]:
-            topics = a_info["topics"].split(" ")
-            zconf = self.topics_install(name, topics, zconf)
+        try:
+            # Stage files and agent file list
+            self.move_files(name, txn)
+            self.stage_executables(name, a_info, txn)
 
-        self.write_conf(zconf)
+            # Add agent to the zoe.conf file
+            zconf = self.read_conf()
 
-        # Update agent list
-        alist[name]["installed"] = "1"
-        alist[name]["version"] = a_info["version"]
+            ports = []
+            for sec in zconf.sections():
+                if "port" in zconf[sec]:
+                    ports.append(int(zconf[sec]["port"]))
+            ports = sorted(ports)
+
+            if not ports:
+                ports.append(env["ZOE_SERVER_PORT"])
+            free_port = ports[0]
+            while free_port in ports:
+                free_port += 1
+
+            zconf.add_section("agent " + name)
+            zconf["agent " + name]["port"] = str(free_port)
+
+            # Topics are optional
+            if a_info["topics"]:
+                topics = a_info["topics"].split(" ")
+                zconf = self.topics_install(name, topics, zconf)
+
+            self.write_conf(zconf, txn)
+
+            # Update agent list
+            alist[name]["installed"] = "1"
+            alist[name]["version"] = a_info["version"]
+
+            self.write_list(alist, txn)
+
+            # Store config files list (if any)
+            info_conf = path(temp, "zam", "conf")
+            if os.path.isfile(info_conf):
+                conflist = []
+                with open(info_conf, "r") as conffile:
+                    for c in conffile.read().splitlines():
+                        conflist.append(c)
+
+                with open(self.staged_path(txn, path(ZAM_INFO,
+                        name + ".conffiles")), "w+") as stored_conf:
+                    for c in conflist:
+                        stored_conf.write("%s\n" % c)
+
+        except Exception as e:
+            # Nothing was changed yet
+            self.logger.info("Could not install '%s': %s" % (name, e))
+            self.end_transaction(txn)
+            self.clean()
+            self.record(name, "install", "failed")
+            return self.feedback(_("Could not install agent '%(name)s': "
+                "%(error)s") % {"name": name, "error": e}, sender, src)
 
-        self.write_list(alist)
+        self.commit_transaction(txn)
 
         self.logger.info("Installed agent '%s'" % name)
+        self.record(name, "install", "ok")
 
         # POSTINSTALL
         postinst = path(temp, "zam", "postinst")
         if os.path.isfile(postinst):
-            st = os.stat(postinst)
-            os.chmod(postinst, st.st_mode | stat.S_IEXEC)
-            proc = subprocess.call([postinst, ])
+            proc = subprocess.call([self.hook_script(name, postinst), ])
 
             self.logger.debug("Ran postinst script, got code %i" % proc)
 
-        # Store config files list (if any)
-        info_conf = path(temp, "zam", "conf")
-        if os.path.isfile(info_conf):
-            conflist = []
-            with open(info_conf, "r") as conffile:
-                for c in conffile.read().splitlines():
-                    conflist.append(c)
-
-            with open(path(ZAM_INFO, name + ".conffiles"), "w+") as stored_conf:
-                for c in conflist:
-                    stored_conf.write("%s\n" % c)
+        # Store hashes of the installed files for integrity checks
+        self.write_manifest(name, self.list_files(name))
 
         # Cleanup
         self.clean()
 
         # Launch the agent (and register it)
         if a_info["script"]:
-            self.sendbus(self.feedback(
-                _("Agent '%s' installed correctly") % name, sender, src).msg())
+            self.notify(
+                _("Agent '%s' installed correctly") % name, sender, src)
             return self.launch(parser)
 
     @Message(tags=["launch"])
+    @profiled
     def launch(self, parser):
         """ Launch an agent.
 
@@ -315,11 +648,7 @@ class AgentManager:
             return self.feedback(
                 _("Agent '%s' does not exist!") % name, sender, src)
 
-        # Redirect stdout and stderr to zam's log
-        log_file = open(path(env["ZOE_LOGS"], "zam.log"), "a")
-        proc = subprocess.Popen([ZOE_LAUNCHER,
-            "launch-agent", name], stdout=log_file, stderr=log_file,
-            cwd=env["ZOE_HOME"])
+        self.run_launcher("launch-agent", name)
 
         zconf = self.read_conf()
 
@@ -333,11 +662,94 @@ class AgentManager:
             "port": port
         }
 
-        self.sendbus(
-            self.feedback(_("Launching agent '%s'") % name, sender, src).msg())
+        self.record(name, "launch", "ok")
+
+        self.notify(_("Launching agent '%s'") % name, sender, src)
         return zoe.MessageBuilder(launch_msg)
 
+    @Message(tags=["profile"])
+    def profile(self, parser):
+        """ Profile the next message handlers.
+
+            Results are written to var/zam/profiles as a .pstats file (CPU
+            profiles) and a text summary.
+
+            mode     - 'cpu' to use cProfile (default) or 'memory' to use
+                tracemalloc
+            messages - number of messages to profile (default 10)
+            seconds  - stop profiling after this many seconds (default 600)
+            top      - number of entries in the summary (default 30)
+            stop     - if '1', stop the current session and write the results
+            sender   - sender of the message
+            src      - channel from which the message was obtained
+        """
+        mode, messages, seconds, top, stop, sender, src = self.multiparse(
+            parser, ['mode', 'messages', 'seconds', 'top', 'stop', 'sender',
+                'src'])
+
+        self.set_locale(sender)
+
+        if not self.has_permissions(sender):
+            self.logger.info("%s tried to profile zam" % sender)
+            return self.feedback(_("You don't have permissions to do that"),
+                sender, src)
+
+        if stop == "1":
+            if self.profiler is None:
+                return self.feedback(_("Profiling is not active"),
+                    sender, src)
+
+            summary = self.finish_profile()
+            return self.feedback(_("Profile written to %s") % summary,
+                sender, src)
+
+        if self.profiler is not None:
+            return self.feedback(_("Profiling is already active"),
+                sender, src)
+
+        mode = mode or "cpu"
+        if mode not in ["cpu", "memory"]:
+            return self.feedback(_("Unknown profiling mode '%s'") % mode,
+                sender, src)
+
+        try:
+            messages = int(messages or 10)
+            seconds = int(seconds or 600)
+            top = int(top or 30)
+        except ValueError:
+            messages, seconds, top = 10, 600, 30
+
+        session = {
+            "mode": mode,
+            "remaining": messages,
+            "deadline": time.time() + seconds,
+            "top": top,
+            "depth": 0,
+            "calls": [],
+            "started": time.time(),
+            "sender": sender,
+            "src": src
+        }
+
+        if mode == "cpu":
+            import cProfile
+            session["profile"] = cProfile.Profile()
+
+        else:
+            import tracemalloc
+            tracemalloc.start(10)
+
+        self.profiler = session
+
+        self.logger.info("Profiling the next %d messages (%s)" % (
+            messages, mode))
+
+        return self.feedback(_("Profiling the next %(messages)d messages "
+            "(%(mode)s)") % {"messages": messages, "mode": mode},
+            sender, src)
+
     @Message(tags=["purge"])
+    @profiled
     def purge(self, parser):
         """ Remove an agent's configuration files.
 
@@ -380,10 +792,102 @@ class AgentManager:
         os.remove(confpath)
 
         self.logger.info("Agent '%s' purged" % name)
+        self.record(name, "purge", "ok")
 
         return self.feedback(_("Agent '%s' purged") % name, sender, src)
 
+    @Message(tags=["registry"])
+    @profiled
+    def build_registry(self, parser):
+        """ Rebuild the registry of available agents.
+
+            Every directory inside the given one is checked for a zam/info
+            file, either as a checkout or as a bare git mirror. The source
+            of an agent is the origin of its checkout or the path to the
+            git repository of the mirror or checkout itself, so that it is
+            always cloned. When several directories provide the same agent,
+            the newest version is kept.
+
+            path    - directory containing the mirrors or checkouts. If not
+                present, the one in the [registry] section of
+                etc/zam/zam.conf is used
+            sender  - sender of the message
+            src     - channel from which the message was obtained
+        """
+        from configparser import ConfigParser
+
+        mirrors, sender, src = self.multiparse(
+            parser, ['path', 'sender', 'src'])
+
+        self.set_locale(sender)
+
+        if not self.has_permissions(sender):
+            self.logger.info("%s tried to rebuild the registry" % sender)
+            return self.feedback(_("You don't have permissions to do that"),
+                sender, src)
+
+        if not mirrors:
+            mirrors = self.read_settings()["registry"].get("mirrors")
+
+        if not mirrors or not os.path.isdir(mirrors):
+            self.logger.info("Mirror directory not found: %s" % mirrors)
+            return self.feedback(
+                _("Directory '%s' not found") % mirrors, sender, src)
+
+        from semantic_version import Version
+
+        registry = ConfigParser(interpolation=None)
+        duplicates = set()
+
+        with os.scandir(mirrors) as entries:
+            # Sorted so that the result does not depend on the directory
+            dirs = sorted(e.path for e in entries if e.is_dir())
+
+        for mirror in dirs:
+            a_info = self.mirror_info(mirror)
+            if not a_info:
+                continue
+
+            name = a_info["agent"] or os.path.basename(mirror)
+            if name.endswith(".git"):
+                name = name[:-len(".git")]
+
+            if name in registry:
+                duplicates.add(name)
+                self.logger.info("Agent '%s' found in several mirrors" % name)
+
+                try:
+                    newer = Version(a_info["version"]) > Version(
+                        registry[name]["version"])
+                except (ValueError, TypeError):
+                    newer = False
+
+                if not newer:
+                    continue
+
+            registry[name] = {
+                "source": a_info["source"],
+                "version": a_info["version"] or "",
+                "description": a_info["description"] or "",
+                "topics": a_info["topics"] or ""
+            }
+
+        with open(ZAM_REGISTRY, "w") as rfile:
+            registry.write(rfile)
+
+        self.logger.info("Registry rebuilt with %d agents" %
+            len(registry.sections()))
+
+        msg = _("Registry rebuilt with %d agents") % len(registry.sections())
+
+        if duplicates:
+            msg += "\n" + _("Found in several mirrors (newest kept): %s") % (
+                " ".join(sorted(duplicates)))
+
+        return self.feedback(msg, sender, src)
+
     @Message(tags=["remove"])
+    @profiled
     def remove(self, parser):
         """ Uninstall an agent.
 
@@ -404,6 +908,9 @@ class AgentManager:
             return self.feedback(_("You don't have permissions to do that"),
                 sender, src)
 
+        # Finish any interrupted operation on the agent first
+        self.recover_transactions(name)
+
         alist = self.read_list()
 
         if not self.installed(name, alist):
@@ -414,6 +921,8 @@ class AgentManager:
         if self.running(name):
             self.stop(parser)
 
+        txn = self.begin_transaction(name, "remove")
+
         # Remove from zoe.conf
         zconf = self.read_conf()
 
@@ -434,35 +943,34 @@ class AgentManager:
                 # Not in the list
                 continue
 
-        self.write_conf(zconf)
-
-        # Remove agent files and directories
-        flist_path = path(ZAM_INFO, name + ".list")
-        with open(flist_path, "r") as flist:
-            for f in flist.read().splitlines():
-                l = path(env["ZOE_HOME"], f)
-                # Remove final file
-                os.remove(l)
-                # Remove the tree that was generated in the installation
-                dirs = os.path.split(l)
-                while dirs[0] != "/":
-                    if os.listdir(dirs[0]):
-                        break
-                    shutil.rmtree(dirs[0])
-                    dirs = os.path.split(dirs[0])
-
-        os.remove(flist_path)
+        self.write_conf(zconf, txn)
+
+        # Agent files and directories are removed on commit
+        with open(path(txn["stage"], "remove"), "w") as rfile:
+            for f in self.list_files(name):
+                rfile.write("%s\n" % f)
+
+        txn["delete"] = [os.path.relpath(path(ZAM_INFO, name + ext),
+            env["ZOE_HOME"]) for ext in [".list", ".manifest"]]
 
         # Update agent list
         alist[name]["installed"] = "0"
         alist[name]["version"] = ""
-        self.write_list(alist)
+        alist.remove_option(name, "watch")
+        self.write_list(alist, txn)
+
+        self.commit_transaction(txn)
+
+        self.watches.pop(name, None)
+        self.discard_staged(name)
 
         self.logger.info("'%s' has been uninstalled" % name)
+        self.record(name, "remove", "ok")
 
         return self.feedback(_("Agent '%s' uninstalled") % name, sender, src)
 
     @Message(tags=["restart"])
+    @profiled
     def restart(self, parser):
         """ Restart an agent.
 
@@ -485,15 +993,141 @@ class AgentManager:
             return self.feedback(_("Agent '%s' is not running") % name,
                 sender, src)
 
-        # Redirect stdout and stderr to zam's log
-        log_file = open(path(env["ZOE_LOGS"], "zam.log"), "a")
-        proc = subprocess.Popen([ZOE_LAUNCHER,
-            "restart-agent", name], stdout=log_file, stderr=log_file,
-            cwd=env["ZOE_HOME"])
+        self.run_launcher("restart-agent", name)
+
+        self.record(name, "restart", "ok")
 
         return self.feedback(_("Restarting agent '%s'") % name, sender, src)
 
+    @Message(tags=["search"])
+    @profiled
+    def search(self, parser):
+        """ Search the registry for agents.
+
+            Every word of the query must be the beginning of the name, a
+            topic or a word of the description of the agent.
+
+            query*  - words to search
+            page    - page of the results to show
+            sender  - sender of the message
+            src     - channel from which the message was obtained
+        """
+        query, page, sender, src = self.multiparse(
+            parser, ['query', 'page', 'sender', 'src'])
+
+        self.set_locale(sender)
+
+        if not self.has_permissions(sender):
+            self.logger.info("%s tried to search the registry" % sender)
+            return self.feedback(_("You don't have permissions to do that"),
+                sender, src)
+
+        registry, tokens = self.registry_index()
+
+        found = None
+        for word in self.tokenize(query or ""):
+            # Tokens starting with the word are contiguous in the index
+            matches = set()
+            i = bisect.bisect_left(tokens, (word, ""))
+            while i < len(tokens) and tokens[i][0].startswith(word):
+                matches.add(tokens[i][1])
+                i += 1
+
+            found = matches if found is None else found & matches
+
+        if not found:
+            return self.feedback(_("No agents found"), sender, src)
+
+        report = [_("%(name)s %(version)s: %(description)s") % {
+            "name": name,
+            "version": registry[name]["version"] or "-",
+            "description": registry[name]["description"] or "-"
+            } for name in sorted(found)]
+
+        return self.feedback(self.paginate(report, page), sender, src)
+
+    @Message(tags=["status"])
+    @profiled
+    def status(self, parser):
+        """ Show the state of the agents in the list.
+
+            The report is built from the cached agent index and the .pid
+            files found in a single pass over ZOE_VAR, so it is cheap enough
+            to be polled periodically.
+
+            name    - show only agents whose name starts with this prefix
+            state   - show only agents in this state (running, stopped,
+                dead, installed, uninstalled)
+            page    - page of the report to show
+            sender  - sender of the message
+            src     - channel from which the message was obtained
+        """
+        name, state, page, sender, src = self.multiparse(
+            parser, ['name', 'state', 'page', 'sender', 'src'])
+
+        self.set_locale(sender)
+
+        if not self.has_permissions(sender):
+            self.logger.info("%s tried to check agent status" % sender)
+            return self.feedback(_("You don't have permissions to do that"),
+                sender, src)
+
+        labels = {
+            "running": _("running"),
+            "stopped": _("stopped"),
+            "dead": _("dead"),
+            "uninstalled": _("not installed")
+        }
+
+        index = self.agent_index()
+        pids = self.pid_files()
+        now = time.time()
+
+        report = []
+        for agent in sorted(index):
+            if name and not agent.startswith(name):
+                continue
+
+            info = index[agent]
+            pid = pids.get(agent)
+            uptime = ""
+
+            if not info["installed"]:
+                agent_state = "uninstalled"
+            elif not pid:
+                agent_state = "stopped"
+            elif self.alive(pid[0]):
+                agent_state = "running"
+                uptime = " (%s)" % self.format_uptime(now - pid[1])
+            else:
+                agent_state = "dead"
+
+            if state and state != agent_state and not (
+                    state == "installed" and agent_state != "uninstalled"):
+                continue
+
+            last = self.ops.get(agent)
+
+            report.append(_("%(name)s %(version)s (%(source)s): "
+                "%(state)s%(uptime)s, port %(port)s, topics %(topics)s, "
+                "last %(last)s") % {
+                    "name": agent,
+                    "version": info["version"] or "-",
+                    "source": info["source"] or "-",
+                    "state": labels[agent_state],
+                    "uptime": uptime,
+                    "port": info["port"] or "-",
+                    "topics": " ".join(info["topics"]) or "-",
+                    "last": "%s %s" % (last[0], last[1]) if last else "-"
+                })
+
+        if not report:
+            return self.feedback(_("No agents found"), sender, src)
+
+        return self.feedback(self.paginate(report, page), sender, src)
+
     @Message(tags=["stop"])
+    @profiled
     def stop(self, parser):
         """ Stop an agent's execution.
 
@@ -516,15 +1150,14 @@ class AgentManager:
             return self.feedback(
                 _("Agent '%s' is not running") % name, sender, src)
 
-        # Redirect stdout and stderr to zam's log
-        log_file = open(path(env["ZOE_LOGS"], "zam.log"), "a")
-        proc = subprocess.Popen([ZOE_LAUNCHER,
-            "stop-agent", name], stdout=log_file, stderr=log_file,
-            cwd=env["ZOE_HOME"])
+        self.run_launcher("stop-agent", name)
+
+        self.record(name, "stop", "ok")
 
         return self.feedback(_("Stopping agent '%s'") % name, sender, src)
 
     @Message(tags=["update"])
+    @profiled
     def update(self, parser):
         """ Update an installed agent.
 
@@ -532,6 +1165,8 @@ class AgentManager:
             sender  - sender of the message
             src     - channel from which the message was obtained
         """
+        from semantic_version import Version
+
         name, sender, src = self.multiparse(
             parser, ['name', 'sender', 'src'])
 
@@ -542,6 +1177,9 @@ class AgentManager:
             return self.feedback(_("You don't have permissions to do that"),
                 sender, src)
 
+        # Finish any interrupted operation on the agent first
+        self.recover_transactions(name)
+
         alist = self.read_list()
 
         if not self.installed(name, alist):
@@ -551,15 +1189,16 @@ class AgentManager:
 
         self.clean()
 
-        # Get source
+        # Get source (prefetched if available)
         temp = path(ZAM_TEMP, name)
-        git_code = self.fetch(name, alist[name]["source"])
+        git_code = self.fetch(name, alist[name]["source"], True)
 
         if git_code != 0:
             self.logger.info("Could not fetch source: %s" %
                 alist[name]["source"])
 
             self.clean()
+            self.record(name, "update", "fetch failed")
             return self.feedback(_("Could not fetch source"), sender, src)
 
         # Parse information
@@ -568,114 +1207,820 @@ class AgentManager:
         # Version is mandatory!
         if not a_info["version"]:
             self.logger.info("Missing version information")
+            self.record(name, "update", "missing version")
+            self.clean()
             return self.feedback(
                 _("Missing version in info file for '%s'") % name, sender, src)
 
         remote_ver = Version(a_info["version"])
         local_ver = Version(alist[name]["version"])
 
-        if remote_ver <= local_ver:
+        # Local sources are synced if their files changed, even if the
+        # version did not
+        if remote_ver <= local_ver and not (os.path.islink(temp) and
+                self.local_changed(name)):
             self.logger.info("'%s' is already up-to-date" % name)
+            self.record(name, "update", "up-to-date")
+            self.clean()
             return self.feedback(
                 _("Agent '%s' is already up-to-date") % name, sender, src)
 
-        # PREUPDATE
-        preupd = path(temp, "zam", "preupd")
-        if os.path.isfile(preupd):
-            st = os.stat(preupd)
-            os.chmod(preupd, st.st_mode | stat.S_IEXEC)
-            proc = subprocess.call([preupd, ])
-
-            self.logger.debug("Ran preupd script, got code %i" % proc)
-
         # UPDATE
-        # Move files
-        file_list = self.move_files(name, True)
-
-        # Save agent file list
-        with open(path(ZAM_INFO, name + ".list"), "w+") as dfile:
-            for f in file_list:
-                dfile.write("%s\n" % f)
-
-        # Make script executable
-        #
-        # There may be cases where an agent is only formed by natural
-        # language files, so this key may not be present.
-        if a_info["script"]:
-            script = path(env["ZOE_HOME"], "agents",
-                name, a_info["script"])
-            st = os.stat(script)
-            os.chmod(script, st.st_mode | stat.S_IEXEC)
-
-        # Make cmdproc and mailproc scripts executable
-        for f in [cf for cf in file_list if cf.startswith("cmdproc") or
-                cf.startswith("mailproc")]:
-            df = path(env["ZOE_HOME"], f)
-            st = os.stat(df)
-            os.chmod(df, st.st_mode | stat.S_IEXEC)
-
-        # Update version
-        alist[name]["version"] = str(remote_ver)
-        self.write_list(alist)
-
-        # Update topics (if any)
-        if a_info["topics"]:
-            topics = a_info["topics"].split(" ")
-            zconf = self.topics_update(name, topics)
-
-            self.write_conf(zconf)
-
-        self.logger.info("Updated '%s'" % name)
+        try:
+            txn = self.sync_files(name, a_info)
 
-        # POSTUPDATE
-        postupd = path(temp, "zam", "postupd")
-        if os.path.isfile(postupd):
-            st = os.stat(postupd)
-            os.chmod(postupd, st.st_mode | stat.S_IEXEC)
-            proc = subprocess.call([postupd, ])
+        except Exception as e:
+            # The transaction was discarded
+            self.logger.info("Could not update '%s': %s" % (name, e))
+            self.clean()
+            self.record(name, "update", "failed")
+            return self.feedback(_("Could not update agent '%(name)s': "
+                "%(error)s") % {"name": name, "error": e}, sender, src)
 
-            self.logger.debug("Ran postupd script, got code %i" % proc)
+        self.finish_update(name, a_info, alist, txn)
 
         # Cleanup
         self.clean()
 
         if a_info["script"]:
             # Restart the agent
-            self.sendbus(
-                self.feedback(_("Updated agent '%s'") % name,
-                    sender, src).msg())
+            self.notify(_("Updated agent '%s'") % name, sender, src)
 
             return self.restart(parser)
 
-    def add_to_list(self, name, source, alist, ret=True):
-        """ Add an agent to the list.
+    @Message(tags=["update-all"])
+    @profiled
+    def update_all(self, parser):
+        """ Update every installed agent that has a newer version.
 
-            name    - name of the agent to install. Will be checked against
-                the agent list
-            source  - git repository URL, or GitHub repository name,
-                of the source
-            alist   - agent list file
-            ret     - whether or not this function should return the new list
+            Sources are fetched and files are applied in parallel. Running
+            agents are then restarted in waves, checking that the agents of
+            a wave are still running before starting the next one. The
+            rollout stops at the first wave with failures.
+
+            sender  - sender of the message
+            src     - channel from which the message was obtained
         """
-        new_alist = alist
-        source_url = source
+        from concurrent.futures import ThreadPoolExecutor
 
-        if re.match("^[a-z0-9-_]+\/[a-z0-9-_]+$", source, re.IGNORECASE):
-            # GitHub repository
-            source_url = "https://github.com/%s.git" % source
+        sender, src = self.multiparse(parser, ['sender', 'src'])
 
-        new_alist.add_section(name)
-        new_alist[name]["source"] = str(source_url)
-        new_alist[name]["installed"] = "0"
-        new_alist[name]["version"] = ""
+        self.set_locale(sender)
 
-        self.write_list(new_alist)
+        if not self.has_permissions(sender):
+            self.logger.info("%s tried to update all agents" % sender)
+            return self.feedback(_("You don't have permissions to do that"),
+                sender, src)
 
-        self.logger.debug("Added new agent %s to the list" % name)
+        if self.rollout and self.rollout.is_alive():
+            self.logger.info("Update of all agents already in progress")
+            return self.feedback(
+                _("An update of all the agents is already in progress"),
+                sender, src)
 
-        if ret:
+        settings = self.read_settings()["update-all"]
+        workers = max(settings.getint("workers"), 1)
+
+        # Finish any interrupted operation first
+        self.recover_transactions()
+
+        alist = self.read_list()
+        names = [a for a in alist.sections()
+            if self.installed(a, alist) and a != "zam"]
+
+        self.clean()
+
+        # Fetch every source and keep those with a newer version
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            infos = list(pool.map(
+                lambda a: self.fetch_update(a, alist), names))
+
+        outdated = [(a, info) for a, info in zip(names, infos) if info]
+
+        if not outdated:
+            self.clean()
+            self.logger.info("All agents are up-to-date")
+            return self.feedback(_("All the agents are up-to-date"),
+                sender, src)
+
+        def sync(update):
+            name, a_info = update
+            try:
+                return self.sync_files(name, a_info)
+
+            except Exception as e:
+                # The other agents are still updated
+                self.logger.info("Could not update '%s': %s" % (name, e))
+                self.record(name, "update", "failed")
+                return None
+
+        # Apply files in parallel, then store versions and topics in order
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            txns = list(pool.map(sync, outdated))
+
+        updated = []
+        failed = []
+        for (name, a_info), txn in zip(outdated, txns):
+            if txn is None:
+                failed.append(name)
+                continue
+
+            try:
+                self.finish_update(name, a_info, alist, txn)
+                updated.append((name, a_info))
+
+            except Exception as e:
+                self.logger.info("Could not update '%s': %s" % (name, e))
+                self.record(name, "update", "failed")
+                failed.append(name)
+
+        # Also removes the fetched sources of the failed agents
+        self.clean()
+
+        restart = [name for name, a_info in updated
+            if a_info["script"] and self.running(name)]
+
+        self.rollout = threading.Thread(target=self.restart_waves,
+            args=(restart, settings, sender, src), daemon=True)
+        self.rollout.start()
+
+        msg = _("Updated %(count)d agents, restarting %(restart)d of them "
+            "in waves of %(wave)d") % {
+                "count": len(updated),
+                "restart": len(restart),
+                "wave": settings.getint("wave")
+            }
+
+        if failed:
+            msg += "\n" + _("Could not update: %s") % " ".join(failed)
+
+        return self.feedback(msg, sender, src)
+
+    @Message(tags=["usage"])
+    @profiled
+    def usage(self, parser):
+        """ Show the disk space and resources used by the installed agents.
+
+            Disk usage includes the agent files, its configuration files and
+            the prefetched source kept by zam. CPU, memory and open files
+            are averaged over the samples taken while the agent is running
+            (see the [usage] section of etc/zam/zam.conf).
+
+            name    - show only agents whose name starts with this prefix
+            sort    - sort by 'disk' (default), 'cpu' or 'rss'
+            page    - page of the report to show
+            sender  - sender of the message
+            src     - channel from which the message was obtained
+        """
+        name, sort, page, sender, src = self.multiparse(
+            parser, ['name', 'sort', 'page', 'sender', 'src'])
+
+        self.set_locale(sender)
+
+        if not self.has_permissions(sender):
+            self.logger.info("%s tried to check agent usage" % sender)
+            return self.feedback(_("You don't have permissions to do that"),
+                sender, src)
+
+        index = self.agent_index()
+
+        rows = []
+        for agent in sorted(a for a in index if index[a]["installed"]):
+            if name and not agent.startswith(name):
+                continue
+
+            disk = self.disk_usage(agent)
+            sampled = self.usage_samples.get(agent)
+            samples = list(sampled["samples"]) if sampled else []
+
+            cpu = [c for t, c, r, f in samples if c is not None]
+            rss = [r for t, c, r, f in samples]
+
+            rows.append({
+                "name": agent,
+                "disk": disk["files"] + disk["conf"] + disk["cache"],
+                "files": disk["count"],
+                "conf": disk["conf"],
+                "cache": disk["cache"],
+                "cpu": sum(cpu) / len(cpu) if cpu else 0.0,
+                "cpu_max": max(cpu) if cpu else 0.0,
+                "rss": rss[-1] if rss else 0,
+                "rss_max": max(rss) if rss else 0,
+                "fds": samples[-1][3] if samples else None,
+                "running": bool(samples)
+            })
+
+        if not rows:
+            return self.feedback(_("No agents found"), sender, src)
+
+        sort = sort if sort in ["cpu", "rss"] else "disk"
+        rows.sort(key=lambda r: r[sort], reverse=True)
+
+        report = []
+        for row in rows:
+            line = _("%(name)s: disk %(disk)s (%(files)d files, config "
+                "%(conf)s, cache %(cache)s)") % dict(row,
+                    disk=self.format_size(row["disk"]),
+                    conf=self.format_size(row["conf"]),
+                    cache=self.format_size(row["cache"]))
+
+            if row["running"]:
+                line += ", " + _("cpu %(cpu).1f%% (max %(cpu_max).1f%%), "
+                    "memory %(rss)s (max %(rss_max)s), %(fds)s open "
+                    "files") % dict(row,
+                        rss=self.format_size(row["rss"]),
+                        rss_max=self.format_size(row["rss_max"]),
+                        fds="-" if row["fds"] is None else row["fds"])
+            else:
+                line += ", " + _("not running")
+
+            report.append(line)
+
+        report.insert(0, _("Total: disk %(disk)s, memory %(rss)s") % {
+            "disk": self.format_size(sum(r["disk"] for r in rows)),
+            "rss": self.format_size(sum(r["rss"] for r in rows))
+        })
+
+        return self.feedback(self.paginate(report, page), sender, src)
+
+    @Message(tags=["verify"])
+    @profiled
+    def verify(self, parser):
+        """ Check the installed files of agents against their manifest.
+
+            Files whose size and modification time did not change since the
+            manifest was written are not hashed again, unless a full check
+            is requested.
+
+            name      - agent to check. If not present, all the installed
+                agents are checked
+            conffiles - if '1', also report changes in configuration files
+            full      - if '1', hash every file
+            repair    - if '1', fetch the source again and restore only the
+                files that changed or went missing
+            sender    - sender of the message
+            src       - channel from which the message was obtained
+        """
+        name, conffiles, full, repair, sender, src = self.multiparse(
+            parser, ['name', 'conffiles', 'full', 'repair', 'sender', 'src'])
+
+        self.set_locale(sender)
+
+        if not self.has_permissions(sender):
+            self.logger.info("%s tried to verify agents" % sender)
+            return self.feedback(_("You don't have permissions to do that"),
+                sender, src)
+
+        alist = self.read_list()
+
+        if name:
+            if not self.installed(name, alist):
+                self.logger.info("'%s' is not installed" % name)
+                return self.feedback(
+                    _("Agent '%s' is not installed") % name, sender, src)
+
+            names = [name]
+
+        else:
+            names = [a for a in alist.sections() if self.installed(a, alist)]
+
+        drift = self.verify_files(names, conffiles == "1", full == "1")
+
+        report = []
+        for agent in names:
+            result = drift[agent]
+
+            if result is None:
+                report.append(
+                    _("%s: no manifest found, stored current files") % agent)
+                continue
+
+            changed = result["missing"] + result["modified"] + result["mode"]
+
+            if repair == "1" and changed:
+                repaired = self.repair_files(agent, alist, changed)
+
+                if repaired is None:
+                    report.append(_("%s: could not repair, fetch the source "
+                        "or update the agent") % agent)
+                    continue
+
+                repaired, failed = repaired
+                report.append(_("%(name)s: repaired %(count)d files") % {
+                    "name": agent, "count": len(repaired)})
+
+                if failed:
+                    report.append(_("%(name)s: could not restore %(count)d "
+                        "files, not found in the source") % {
+                            "name": agent, "count": len(failed)})
+                    report += ["  " + f for f in failed]
+                continue
+
+            if not changed and not result["conffiles"]:
+                report.append(_("%s: OK") % agent)
+                continue
+
+            report.append(_("%(name)s: %(missing)d missing, %(modified)d "
+                "modified, %(mode)d with different mode, %(conf)d "
+                "configuration files changed") % {
+                    "name": agent,
+                    "missing": len(result["missing"]),
+                    "modified": len(result["modified"]),
+                    "mode": len(result["mode"]),
+                    "conf": len(result["conffiles"])
+                })
+
+            for f in changed + result["conffiles"]:
+                report.append("  " + f)
+
+            self.logger.info("Drift in '%s': %s" % (agent, " ".join(changed)))
+
+        return self.feedback("\n".join(report), sender, src)
+
+    @Message(tags=["watch"])
+    @profiled
+    def watch(self, parser):
+        """ Sync and restart an agent installed from a local directory
+            whenever its source files change.
+
+            name*   - unique name of the agent
+            stop    - if '1', stop watching the agent
+            sender  - sender of the message
+            src     - channel from which the message was obtained
+        """
+        name, stop, sender, src = self.multiparse(
+            parser, ['name', 'stop', 'sender', 'src'])
+
+        self.set_locale(sender)
+
+        if not self.has_permissions(sender):
+            self.logger.info("%s tried to watch an agent" % sender)
+            return self.feedback(_("You don't have permissions to do that"),
+                sender, src)
+
+        alist = self.read_list()
+
+        if not self.installed(name, alist):
+            self.logger.info("'%s' is not installed" % name)
+            return self.feedback(
+                _("Agent '%s' is not installed") % name, sender, src)
+
+        if stop == "1":
+            if self.watches.pop(name, None) is None:
+                return self.feedback(
+                    _("Agent '%s' is not being watched") % name, sender, src)
+
+            alist.remove_option(name, "watch")
+            self.write_list(alist)
+
+            self.logger.info("Stopped watching '%s'" % name)
+            return self.feedback(
+                _("Stopped watching '%s'") % name, sender, src)
+
+        if name in self.watches:
+            return self.feedback(
+                _("Agent '%s' is already being watched") % name, sender, src)
+
+        if not self.start_watch(name, alist[name]["source"]):
+            return self.feedback(
+                _("Agent '%s' is not installed from a local directory") % name,
+                sender, src)
+
+        alist[name]["watch"] = "1"
+        self.write_list(alist)
+
+        self.logger.info("Watching '%s'" % name)
+        return self.feedback(
+            _("Watching '%s' for changes") % name, sender, src)
+
+    @Timed(60)
+    def prefetch_tick(self):
+        """ Start a background prefetch of agent sources when due.
+
+            See the [prefetch] section of etc/zam/zam.conf.
+        """
+        settings = self.read_settings()["prefetch"]
+
+        if settings.get("enabled") != "1" or time.time() < self.next_prefetch:
+            return
+
+        if self.prefetcher and self.prefetcher.is_alive():
+            return
+
+        # Do not compete with the server when the machine is busy
+        load = os.getloadavg()[0] / (os.cpu_count() or 1)
+        if load > settings.getfloat("max_load"):
+            self.logger.debug("Load too high (%.2f), delaying prefetch" % load)
+            return
+
+        jitter = settings.getint("jitter")
+        self.next_prefetch = (time.time() + settings.getint("interval") +
+            random.uniform(-jitter, jitter))
+
+        self.prefetcher = threading.Thread(target=self.prefetch,
+            args=(settings,), daemon=True)
+        self.prefetcher.start()
+
+    @Timed(60)
+    def profile_tick(self):
+        """ End the profiling session once its time is over, even if no
+            messages arrive.
+        """
+        session = self.profiler
+        if session is None or time.time() <= session["deadline"]:
+            return
+
+        summary = self.finish_profile()
+        if summary:
+            self.notify(_("Profile written to %s") % summary,
+                session["sender"], session["src"])
+
+    @Timed(60)
+    def maintenance_tick(self):
+        """ Update all the agents once a day within the maintenance window.
+
+            See the [update-all] section of etc/zam/zam.conf.
+        """
+        window = self.read_settings()["update-all"].get("window")
+        if not window:
+            return
+
+        try:
+            start, end = [time.strptime(t.strip(), "%H:%M")
+                for t in window.split("-")]
+        except ValueError:
+            self.logger.info("Invalid maintenance window: %s" % window)
+            return
+
+        now = time.localtime()
+        current = (now.tm_hour, now.tm_min)
+        start = (start.tm_hour, start.tm_min)
+        end = (end.tm_hour, end.tm_min)
+
+        if start <= end:
+            inside = start <= current < end
+        else:
+            # Window crosses midnight
+            inside = current >= start or current < end
+
+        # Windows crossing midnight count as the day they started
+        day = time.strftime("%Y-%m-%d", time.localtime(
+            time.time() - (86400 if current < start else 0)))
+
+        if not inside or self.last_window == day:
+            return
+
+        self.last_window = day
+        self.logger.info("Starting scheduled update of all agents")
+
+        # Handled like any other message, after the ones already queued
+        self.sendbus(zoe.MessageBuilder(
+            {"dst": "zam", "tag": "update-all"}).msg())
+
+    @Timed(WATCH_INTERVAL)
+    def watch_tick(self):
+        """ Update the watched agents once their local source has not
+            changed for a while.
+
+            See the watch tag.
+        """
+        for name, watch in list(self.watches.items()):
+            if watch["signature"] is not None:
+                # No inotify, poll the tree
+                signature = self.tree_signature(watch["path"])
+                if signature != watch["signature"]:
+                    watch["signature"] = signature
+                    watch["changed"] = time.time()
+
+            if not watch["changed"] or (
+                    time.time() - watch["changed"] < WATCH_SETTLE):
+                continue
+
+            watch["changed"] = None
+            self.logger.info("Source of '%s' changed" % name)
+
+            # Synced and restarted by the update handler
+            self.sendbus(zoe.MessageBuilder(
+                {"dst": "zam", "tag": "update", "name": name}).msg())
+
+    @Timed(USAGE_TICK)
+    def usage_tick(self):
+        """ Sample the running agents and write the metrics file when due.
+
+            See the [usage] section of etc/zam/zam.conf.
+        """
+        settings = self.read_settings()["usage"]
+
+        interval = settings.getint("interval")
+        if interval <= 0 or time.time() < self.next_sample:
+            return
+
+        self.next_sample = time.time() + interval
+        self.sample_usage(settings)
+
+        if settings.get("metrics"):
+            self.write_metrics(settings.get("metrics"))
+
+    def add_to_list(self, name, source, alist, ret=True):
+        """ Add an agent to the list.
+
+            name    - name of the agent to install. Will be checked against
+                the agent list
+            source  - git repository URL, GitHub repository name or
+                local directory (path or file:// URL) of the source
+            alist   - agent list file
+            ret     - whether or not this function should return the new list
+        """
+        new_alist = alist
+        source_url = source
+
+        if re.match("^[a-z0-9-_]+\/[a-z0-9-_]+$", source, re.IGNORECASE):
+            # GitHub repository
+            source_url = "https://github.com/%s.git" % source
+
+        new_alist.add_section(name)
+        new_alist[name]["source"] = str(source_url)
+        new_alist[name]["installed"] = "0"
+        new_alist[name]["version"] = ""
+
+        self.write_list(new_alist)
+
+        self.logger.debug("Added new agent %s to the list" % name)
+
+        if ret:
             return new_alist
 
+    def agent_index(self):
+        """ Obtain an index of the agents in the list, including the port
+            and topics assigned to them in the zoe.conf file.
+
+            The index is cached and only rebuilt when the agent list or the
+            zoe.conf file are modified.
+        """
+        key = []
+        for f in [ZAM_LIST, ZCONF_PATH]:
+            try:
+                st = os.stat(f)
+                key.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                key.append(None)
+
+        if key == self.index_key:
+            return self.index
+
+        alist = self.read_list()
+        zconf = self.read_conf()
+
+        # Invert the topic sections once for all the agents
+        topics = {}
+        for sec in [t for t in zconf.sections() if t.startswith("topic ")]:
+            for agent in zconf[sec].get("agents", "").split():
+                topics.setdefault(agent, []).append(sec[len("topic "):])
+
+        index = {}
+        for name in alist.sections():
+            agent_sec = "agent " + name
+            port = None
+            if agent_sec in zconf.sections():
+                port = zconf[agent_sec].get("port")
+
+            index[name] = {
+                "source": alist[name].get("source", ""),
+                "installed": alist[name].get("installed") == "1",
+                "version": alist[name].get("version", ""),
+                "port": port,
+                "topics": sorted(topics.get(name, []))
+            }
+
+        self.index = index
+        self.index_key = key
+        self.save_state()
+
+        return index
+
+    def alive(self, pid):
+        """ Check if the process with the given pid exists. """
+        if not pid:
+            return False
+
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            # Exists, but owned by another user
+            return True
+
+        return True
+
+    def apply_transaction(self, txn):
+        """ Move the staged files of a transaction into ZOE_HOME and remove
+            the files it replaces.
+
+            Files already moved are skipped, so this can be repeated after
+            an interruption.
+        """
+        import shutil
+
+        name = txn["name"]
+        created = set()
+
+        def move(src, fpath):
+            dst = path(env["ZOE_HOME"], fpath)
+
+            parent = os.path.dirname(dst)
+            if parent not in created:
+                os.makedirs(parent, exist_ok=True)
+                created.add(parent)
+
+            # Renamed unless var/zam is in another filesystem
+            shutil.move(src, dst)
+
+        # Agent files first, as listed in the staged file list
+        flist = path(txn["stage"], "meta",
+            os.path.relpath(path(ZAM_INFO, name + ".list"), env["ZOE_HOME"]))
+        if os.path.isfile(flist):
+            with open(flist, "r") as files:
+                for f in [l.rstrip("\n") for l in files]:
+                    staged = path(txn["stage"], "files", f)
+                    if f and os.path.lexists(staged):
+                        move(staged, f)
+
+        removed = path(txn["stage"], "remove")
+        if os.path.isfile(removed):
+            with open(removed, "r") as rfile:
+                for f in [l.rstrip("\n") for l in rfile]:
+                    if f:
+                        self.remove_file(path(env["ZOE_HOME"], f))
+
+        # Then the lists and configuration files that refer to them
+        meta = path(txn["stage"], "meta")
+        for f in list(self.scan_files("", meta)):
+            move(path(meta, f), f)
+
+        for f in txn["delete"]:
+            try:
+                os.remove(path(env["ZOE_HOME"], f))
+            except OSError:
+                # Already removed
+                pass
+
+    def begin_transaction(self, name, op):
+        """ Start a transaction on an agent. Its changes are staged in
+            var/zam/journal/name and ZOE_HOME is not modified until the
+            transaction is committed.
+
+            An unfinished transaction of the agent is recovered first.
+        """
+        import shutil
+
+        self.recover_transactions(name)
+
+        txn = {
+            "name": name,
+            "op": op,
+            "state": "prepare",
+            "started": time.time(),
+            "stage": path(ZAM_JOURNAL, name),
+            # Files (relative to ZOE_HOME) removed once everything else is
+            # in place
+            "delete": []
+        }
+
+        shutil.rmtree(txn["stage"], ignore_errors=True)
+        for d in ["files", "meta"]:
+            os.makedirs(path(txn["stage"], d))
+
+        self.write_journal(txn)
+
+        return txn
+
+    def commit_transaction(self, txn):
+        """ Apply the changes staged in a transaction.
+
+            Once the journal is marked as committed, the transaction is
+            completed even if zam stops, see recover_transactions().
+        """
+        # Staged files must be on disk before the commit is recorded
+        self.sync_tree(txn["stage"])
+
+        txn["state"] = "commit"
+        self.write_journal(txn)
+
+        self.apply_transaction(txn)
+        self.end_transaction(txn)
+
+    def discard_staged(self, name):
+        """ Remove the prefetched source of an agent, waiting for the
+            prefetcher if it is being fetched.
+        """
+        import shutil
+
+        with self.staged_lock(name):
+            shutil.rmtree(path(ZAM_STAGE, name), ignore_errors=True)
+            self.staged.pop(name, None)
+
+    def disk_usage(self, name):
+        """ Obtain the disk space used by an agent, in bytes.
+
+            Returns a dictionary with the size and number of its 'files',
+            the size of its 'conf' files and of the prefetched source kept
+            as 'cache'. The file sizes are taken from the manifest (or file
+            list) and only read again when it changes, and the prefetched
+            source is only walked again when it is updated.
+        """
+        conffiles = []
+        try:
+            with open(path(ZAM_INFO, name + ".conffiles"), "r") as cfile:
+                conffiles = [c for c in cfile.read().splitlines() if c]
+        except OSError:
+            # No config files
+            pass
+
+        mpath = path(ZAM_INFO, name + ".manifest")
+        if not os.path.isfile(mpath):
+            # Installed before manifests were stored
+            mpath = path(ZAM_INFO, name + ".list")
+
+        stage = path(ZAM_STAGE, name)
+
+        key = []
+        for fpath in [mpath, stage, path(stage, ".git", "index")]:
+            try:
+                st = os.stat(fpath)
+                key.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                key.append(None)
+
+        cached = self.disk.get(name)
+
+        if not cached or cached["key"][0] != key[0]:
+            size = count = 0
+            shared = []
+
+            try:
+                with open(mpath, "r") as mfile:
+                    for line in mfile:
+                        fields = line.rstrip("\n").split(" ", 5)
+
+                        if len(fields) == 6 and fields[0] == "f":
+                            f, fsize = fields[5], int(fields[2])
+                        elif len(fields) == 1 and fields[0]:
+                            f = fields[0]
+                            try:
+                                fsize = os.stat(
+                                    path(env["ZOE_HOME"], f)).st_size
+                            except OSError:
+                                continue
+                        else:
+                            continue
+
+                        size += fsize
+                        count += 1
+                        if f in conffiles:
+                            shared.append(f)
+
+            except OSError:
+                # Not installed
+                pass
+
+            cached = {"key": [key[0], None, None], "files": size,
+                "count": count, "shared": shared, "cache": 0}
+
+        if cached["key"][1:] != key[1:]:
+            cached["cache"] = (self.tree_signature(stage, [])[1]
+                if key[1] else 0)
+
+        cached["key"] = key
+        self.disk[name] = cached
+
+        # Config files change while the agent runs
+        conf = 0
+        for c in [c for c in conffiles if c not in cached["shared"]]:
+            try:
+                conf += os.stat(path(env["ZOE_HOME"], c)).st_size
+            except OSError:
+                # Not created yet
+                pass
+
+        return {"files": cached["files"], "count": cached["count"],
+            "conf": conf, "cache": cached["cache"]}
+
+    def end_transaction(self, txn):
+        """ Remove the staging tree and journal of a transaction. """
+        import shutil
+
+        jpath = path(ZAM_JOURNAL, txn["name"] + ".json")
+
+        shutil.rmtree(txn["stage"], ignore_errors=True)
+
+        for fpath in [jpath + ".new", jpath]:
+            try:
+                os.remove(fpath)
+            except OSError:
+                # Not written
+                pass
+
     def feedback(self, message, user, dst):
         """ If there is a sender, send feedback message with status
             through Jabber or Telegram.
@@ -696,8 +2041,67 @@ class AgentManager:
 
         return zoe.MessageBuilder(to_send)
 
-    def fetch(self, name, source):
-        """ Download the source of the agent to var/zam/name. """
+    def finish_profile(self):
+        """ End the current profiling session and write its results.
+
+            Returns the path to the text summary.
+        """
+        with self.profiler_lock:
+            session = self.profiler
+            if session is None:
+                return None
+
+            self.profiler = None
+
+        os.makedirs(ZAM_PROFILES, exist_ok=True)
+        base = path(ZAM_PROFILES, "%s-%s" % (time.strftime("%Y%m%d-%H%M%S",
+            time.localtime(session["started"])), session["mode"]))
+
+        # Sessions started within the same second
+        count = 1
+        while os.path.exists(base + ".txt"):
+            count += 1
+            base = base.rsplit("~", 1)[0] + "~%d" % count
+
+        summary = StringIO()
+        summary.write("%d messages profiled (%s)\n\n" % (
+            len(session["calls"]), session["mode"]))
+        for tag, elapsed in session["calls"]:
+            summary.write("%-12s %.3fs\n" % (tag, elapsed))
+        summary.write("\n")
+
+        if session["mode"] == "cpu":
+            import pstats
+            session["profile"].dump_stats(base + ".pstats")
+
+            stats = pstats.Stats(session["profile"], stream=summary)
+            stats.sort_stats("cumulative").print_stats(session["top"])
+
+        else:
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+            for stat in snapshot.statistics("lineno")[:session["top"]]:
+                summary.write("%s\n" % stat)
+
+        with open(base + ".txt", "w") as sfile:
+            sfile.write(summary.getvalue())
+
+        self.logger.info("Profile written to %s.txt" % base)
+
+        return base + ".txt"
+
+    def fetch(self, name, source, staged=False):
+        """ Download the source of the agent to var/zam/name.
+
+            If 'staged' is True and the prefetcher already downloaded a
+            newer version of the source, that tree is used instead.
+
+            Local directories are not cloned, var/zam/name links to them.
+        """
+        import subprocess
+
         temp = path(ZAM_TEMP, name)
         alist = self.read_list()
 
@@ -709,18 +2113,203 @@ class AgentManager:
         except:
             return -1
 
-        return subprocess.call(["git", "clone", src, temp])
+        if staged and self.take_staged(name, src, temp):
+            self.logger.debug("Using prefetched source for '%s'" % name)
+            return 0
 
-    def has_permissions(self, user):
-        """ Check if the user has permissions necessary to interact with the
+        local = self.local_source(src)
+        if local:
+            try:
+                os.makedirs(ZAM_TEMP, exist_ok=True)
+                os.symlink(local, temp)
+            except OSError:
+                return -1
+
+            self.logger.debug("Using local source %s" % local)
+            return 0
+
+        return subprocess.call(["git", "clone", src, temp])
+
+    def fetch_update(self, name, alist):
+        """ Fetch the source of an installed agent (prefetched if available)
+            for update-all.
+
+            Returns the parsed information file if there is a newer version,
+            None otherwise.
+        """
+        from semantic_version import Version
+
+        source = alist[name]["source"]
+
+        if self.fetch(name, source, True) != 0:
+            self.logger.info("Could not fetch source: %s" % source)
+            self.record(name, "update", "fetch failed")
+            return None
+
+        a_info = self.parse_info(path(ZAM_TEMP, name, "zam", "info"))
+
+        if not a_info["version"]:
+            self.logger.info("Missing version information for '%s'" % name)
+            self.record(name, "update", "missing version")
+            return None
+
+        if (Version(a_info["version"]) <= Version(alist[name]["version"]) and
+                not (os.path.islink(path(ZAM_TEMP, name)) and
+                    self.local_changed(name))):
+            self.record(name, "update", "up-to-date")
+            return None
+
+        return a_info
+
+    def finish_update(self, name, a_info, alist, txn):
+        """ Complete the update of an agent once its files are staged.
+
+            Stores the new version and topics, commits the transaction, runs
+            the postupd script and writes the new manifest.
+        """
+        import subprocess
+        from semantic_version import Version
+
+        # Update version
+        alist[name]["version"] = str(Version(a_info["version"]))
+        self.write_list(alist, txn)
+
+        # Update topics (if any)
+        if a_info["topics"]:
+            topics = a_info["topics"].split(" ")
+            zconf = self.topics_update(name, topics)
+
+            self.write_conf(zconf, txn)
+
+        self.commit_transaction(txn)
+
+        self.logger.info("Updated '%s'" % name)
+        self.record(name, "update", "ok")
+
+        # POSTUPDATE
+        postupd = path(ZAM_TEMP, name, "zam", "postupd")
+        if os.path.isfile(postupd):
+            proc = subprocess.call([self.hook_script(name, postupd), ])
+
+            self.logger.debug("Ran postupd script, got code %i" % proc)
+
+        # Store hashes of the installed files for integrity checks
+        self.write_manifest(name, self.list_files(name))
+
+    def format_size(self, size):
+        """ Format a number of bytes as a short size string. """
+        for unit in ["B", "KB", "MB", "GB"]:
+            if size < 1024 or unit == "GB":
+                break
+            size /= 1024.0
+
+        return ("%d %s" if unit == "B" else "%.1f %s") % (size, unit)
+
+    def format_uptime(self, seconds):
+        """ Format a number of seconds as a short uptime string. """
+        minutes, _s = divmod(int(max(seconds, 0)), 60)
+        hours, minutes = divmod(minutes, 60)
+        days, hours = divmod(hours, 24)
+
+        if days:
+            return "%dd %dh" % (days, hours)
+        if hours:
+            return "%dh %dm" % (hours, minutes)
+
+        return "%dm" % minutes
+
+    def git_command(self, settings, *args):
+        """ Build a git command that runs with low priority and, if
+            configured, limited bandwidth.
+        """
+        import shutil
+
+        cmd = ["nice", "-n", settings.get("nice")]
+
+        if shutil.which("ionice"):
+            cmd += ["ionice", "-c", "3"]
+
+        bandwidth = settings.getint("bandwidth")
+        if bandwidth and shutil.which("trickle"):
+            cmd += ["trickle", "-s", "-d", str(bandwidth)]
+
+        return cmd + ["git"] + list(args)
+
+    def has_permissions(self, user):
+        """ Check if the user has permissions necessary to interact with the
             agent manager (belongs to group 'admins').
         """
+        from zoe.models.users import Users
+
         # No user, manual commands from terminal
         if not user or user in Users().membersof("admins"):
             return True
 
         return False
 
+    def hash_file(self, fpath):
+        """ Obtain the SHA-256 hash of a file.
+
+            Big files are mapped into memory, the rest are read in chunks.
+            Returns None if the file cannot be read.
+        """
+        import hashlib
+        import mmap
+
+        digest = hashlib.sha256()
+
+        try:
+            with open(fpath, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+
+                if size >= HASH_MMAP_SIZE:
+                    with mmap.mmap(f.fileno(), 0,
+                            access=mmap.ACCESS_READ) as mapped:
+                        digest.update(mapped)
+
+                else:
+                    for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+                        digest.update(chunk)
+
+        except OSError:
+            return None
+
+        return digest.hexdigest()
+
+    def hash_files(self, fpaths):
+        """ Hash several files in parallel.
+
+            Returns a dictionary mapping each path to its hash.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        fpaths = list(fpaths)
+        if not fpaths:
+            return {}
+
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS) as pool:
+            return dict(zip(fpaths, pool.map(self.hash_file, fpaths)))
+
+    def healthy(self, name):
+        """ Check if an agent is running after being (re)started. """
+        pid = self.pid_files().get(name)
+
+        return bool(pid) and self.alive(pid[0])
+
+    def hook_script(self, name, fpath):
+        """ Make a script of the zam directory of a fetched source (preinst,
+            postinst, preupd, postupd) executable.
+
+            Scripts of local sources are copied to var/zam first, so that
+            the source is not modified. Returns the path of the script to
+            run.
+        """
+        copy = None
+        if os.path.islink(path(ZAM_TEMP, name)):
+            copy = path(ZAM_TEMP, "%s.%s" % (name, os.path.basename(fpath)))
+
+        return self.make_executable(fpath, copy)
+
     def installed(self, name, alist):
         """ Check if an agent is installed or not. """
         if name in alist.sections():
@@ -729,121 +2318,886 @@ class AgentManager:
 
         return False
 
-    def move_files(self, name, updating=False):
-        """ Move the files and directories to their corresponding ZOE_HOME
-            counterpart.
+    def link_file(self, src, dst, hardlink=True, current=None):
+        """ Place a file of a local source in ZOE_HOME.
+
+            The data is shared with the source when possible: first with a
+            reflink (copy on write) and then with a hard link if allowed,
+            falling back to a regular copy. Nothing is done if the file did
+            not change since the last sync, according to the installed file
+            'current' (defaults to 'dst').
+        """
+        import shutil
+
+        st = os.stat(src)
+        try:
+            current = os.stat(current or dst)
+        except OSError:
+            current = None
+
+        if current and self.same_file(st, current):
+            return
+
+        # Replaced at once, the agent may be running
+        tmp = dst + ".zam"
+        linked = False
+
+        try:
+            import fcntl
+
+            with open(src, "rb") as sfile, open(tmp, "wb") as dfile:
+                fcntl.ioctl(dfile.fileno(), FICLONE, sfile.fileno())
+            shutil.copystat(src, tmp)
+            linked = True
+
+        except (ImportError, OSError):
+            # Not supported by the filesystem
+            pass
+
+        if not linked and hardlink:
+            try:
+                if os.path.lexists(tmp):
+                    os.remove(tmp)
+                os.link(src, tmp)
+                linked = True
+
+            except OSError:
+                # Different filesystem
+                pass
+
+        if not linked:
+            shutil.copy2(src, tmp)
+
+        os.replace(tmp, dst)
+
+    def link_tree(self, src, dst):
+        """ Create a copy of a source tree (except .git) in 'dst' made of
+            hard links to its files, falling back to regular copies.
+        """
+        import shutil
+
+        for root, subdirs, files in os.walk(src):
+            subdirs[:] = [d for d in subdirs if d != ".git"]
+            target = path(dst, os.path.relpath(root, src))
+            os.makedirs(target, exist_ok=True)
+
+            for f in files:
+                try:
+                    os.link(path(root, f), path(target, f))
+                except OSError:
+                    # Different filesystem
+                    shutil.copy2(path(root, f), path(target, f),
+                        follow_symlinks=False)
+
+    def list_files(self, name, txn=None):
+        """ Iterate over the files of an agent stored in
+            etc/zam/info/name.list (the staged one if a transaction is given)
+        """
+        flist = path(ZAM_INFO, name + ".list")
+        if txn:
+            flist = self.staged_path(txn, flist)
+
+        with open(flist, "r") as flist:
+            for line in flist:
+                f = line.rstrip("\n")
+                if f:
+                    yield f
+
+    def local_changed(self, name):
+        """ Check if the files of the local source fetched in var/zam/name
+            changed since they were installed, according to the manifest
+            (hard linked files change along with the source).
+
+            Configuration files are not compared, as they may be edited
+            after the installation.
+        """
+        manifest = self.read_manifest(name)
+        if manifest is None:
+            # Installed before manifests were stored
+            return True
+
+        source_dir = path(ZAM_TEMP, name)
+        conffiles = self.local_conffiles(source_dir)
+
+        with os.scandir(source_dir) as entries:
+            subdirs = [e.name for e in entries if e.name not in [".git", "zam"]
+                and e.is_dir(follow_symlinks=False)]
+
+        found = 0
+        for d in subdirs:
+            for f in self.scan_files(d, source_dir):
+                if f not in manifest:
+                    # New file
+                    return True
+
+                found += 1
+                if f in conffiles:
+                    continue
+
+                st = os.stat(path(source_dir, f))
+                entry = manifest[f]
+
+                # Scripts are made executable when installed
+                if (st.st_size != entry["size"] or
+                        st.st_mtime_ns != entry["mtime"] or
+                        stat.S_IMODE(st.st_mode) | stat.S_IEXEC !=
+                            entry["mode"] | stat.S_IEXEC):
+                    return True
+
+        # Removed files
+        return found != len([f for f in manifest
+            if manifest[f]["kind"] == "f"])
+
+    def local_conffiles(self, source_dir):
+        """ Obtain the configuration files listed in zam/conf of a fetched
+            source.
+        """
+        try:
+            with open(path(source_dir, "zam", "conf"), "r") as conffile:
+                return set(c for c in conffile.read().splitlines() if c)
+
+        except OSError:
+            # No config files
+            return set()
+
+    def local_source(self, source):
+        """ Obtain the directory of a source that is a working tree of an
+            agent in this machine (absolute path or file:// URL).
+
+            Returns None for other sources, which are cloned with git.
+        """
+        if not source:
+            return None
+
+        if source.startswith("file://"):
+            directory = source[len("file://"):]
+        elif os.path.isabs(source):
+            directory = source
+        else:
+            return None
+
+        if not os.path.isfile(path(directory, "zam", "info")):
+            # Bare repository or mirror
+            return None
+
+        return os.path.abspath(directory)
+
+    def mirror_info(self, mirror):
+        """ Read the information file of an agent mirror or checkout.
+
+            Returns the parsed information with an additional 'source' key,
+            or None if the directory does not contain an agent that can be
+            cloned with git.
+
+            Checkouts are never used as local sources (see local_source()),
+            so that installed agents do not share files with the mirrors.
+        """
+        import subprocess
+
+        with open(os.devnull, "w") as null:
+            if os.path.isfile(path(mirror, "zam", "info")):
+                if not os.path.isdir(path(mirror, ".git")):
+                    # Not a git checkout
+                    return None
+
+                with open(path(mirror, "zam", "info")) as ifile:
+                    content = ifile.read()
+
+                source = self.staged_source(mirror)
+
+                if not source or self.local_source(source):
+                    # The repository of the checkout (or of its origin, if
+                    # it is another checkout) is cloned instead
+                    checkout = self.local_source(source) or mirror
+                    source = "file://" + path(os.path.abspath(checkout),
+                        ".git")
+
+            else:
+                # Bare mirror
+                try:
+                    content = subprocess.check_output(["git", "--git-dir",
+                        mirror, "show", "HEAD:zam/info"],
+                        stderr=null).decode()
+                except (subprocess.CalledProcessError, OSError):
+                    return None
+
+                source = ""
+
+        a_info = self.parse_info_string(content)
+        a_info["source"] = source or "file://" + os.path.abspath(mirror)
+
+        return a_info
+
+    def load_staged(self):
+        """ Find the prefetched sources kept in var/zam/staged by a previous
+            run that are newer than the installed agents.
+        """
+        from semantic_version import Version
+
+        alist = self.read_list()
+
+        try:
+            names = os.listdir(ZAM_STAGE)
+        except OSError:
+            # Nothing prefetched
+            return
+
+        for name in [n for n in names if self.installed(n, alist)]:
+            stage = path(ZAM_STAGE, name)
+
+            try:
+                source = self.staged_source(stage)
+                a_info = self.parse_info(path(stage, "zam", "info"))
+                version = alist[name].get("version")
+
+                if source == alist[name]["source"] and a_info["version"] and (
+                        not version or
+                        Version(a_info["version"]) > Version(version)):
+                    self.staged.setdefault(name, (source, a_info["version"]))
+
+            except Exception as e:
+                self.logger.debug("Ignoring prefetched source of '%s': %s" % (
+                    name, e))
+
+    def load_state(self):
+        """ Load the agent index, registry and last operations saved by a
+            previous run.
+
+            The index and registry are only used while the files they were
+            built from do not change, see agent_index() and
+            registry_index().
+        """
+        try:
+            with open(ZAM_OPS, "r") as ofile:
+                self.ops = {n: tuple(op) for n, op in json.load(ofile).items()}
+
+        except (OSError, ValueError, AttributeError, TypeError):
+            # Not saved yet or unreadable
+            pass
+
+        try:
+            with open(ZAM_STATE, "r") as sfile:
+                state = json.load(sfile)
+
+            index_key = [tuple(k) if k else None for k in state["index_key"]]
+            registry_key = (tuple(state["registry_key"])
+                if state["registry_key"] else None)
+            registry_tokens = [tuple(t) for t in state["registry_tokens"]]
+
+        except (OSError, ValueError, KeyError, TypeError):
+            # Not saved yet or unreadable
+            return
+
+        self.index = state["index"]
+        self.index_key = index_key
+        self.registry = state["registry"]
+        self.registry_tokens = registry_tokens
+        self.registry_key = registry_key
+
+    def make_executable(self, fpath, copy=None):
+        """ Add the execute permission to a file.
+
+            A file that shares its data with another one (a hard link to a
+            local source or to the prefetched tree) is replaced by a copy
+            first, so that the other one is not changed. If 'copy' is given,
+            the file is copied there instead.
+
+            Returns the path of the executable file.
+        """
+        import shutil
+
+        if os.stat(fpath).st_mode & stat.S_IEXEC:
+            # Already executable
+            return fpath
+
+        if copy:
+            shutil.copy2(fpath, copy)
+            fpath = copy
+
+        elif os.stat(fpath).st_nlink > 1:
+            shutil.copy2(fpath, fpath + ".zam")
+            os.replace(fpath + ".zam", fpath)
+
+        st = os.stat(fpath)
+        os.chmod(fpath, st.st_mode | stat.S_IEXEC)
+
+        return fpath
+
+    def move_files(self, name, txn, updating=False):
+        """ Stage the files and directories of the fetched source in the
+            transaction, along with the new etc/zam/info/name.list
 
             To be used only by install() and update()
 
-            Returns the destination file list
+            The source tree is walked as the files are moved by a pool of
+            threads, so memory use does not grow with the number of files.
+
+            Files of local sources are linked when possible and only those
+            that changed are staged (see link_file()).
         """
+        from concurrent.futures import ThreadPoolExecutor
+
         source_dir = path(ZAM_TEMP, name)
+        stage = path(txn["stage"], "files")
 
-        # Generate list of source files
-        src_list = []
-        for d in os.listdir(source_dir):
-            if os.path.isdir(path(source_dir, d)) and d not in [".git", "zam"]:
-                subdir = path(source_dir, d)
-                for root, dirs, files in os.walk(subdir):
-                    for f in files:
-                        src_list.append(path(root, f))
+        # Local sources are linked instead of cloned, see fetch()
+        local = os.path.islink(source_dir)
+
+        # Config files and scripts are never hard linked, so that editing
+        # them or making them executable does not modify the source
+        copies = set()
+        if local:
+            copies = self.local_conffiles(source_dir)
+            a_info = self.parse_info(path(source_dir, "zam", "info"))
+            if a_info["script"]:
+                copies.add(path("agents", name, a_info["script"]))
 
         if updating:
-            # Diff list
-            diff_list = []
-            for src in src_list:
-                stripped = src.replace(source_dir, "")
-                stripped = self.remove_slash(stripped)
-                diff_list.append(stripped)
-
-            # Compare file lists and remove those not present in the update
-            alist_path = path(ZAM_INFO, name + ".list")
-            with open(alist_path, "r") as alist:
-                for f in [p for p in alist.read().splitlines() if p not in diff_list]:
-                    l = path(env["ZOE_HOME"], f)
-                    # Remove final file
-                    os.remove(l)
-                    # Remove the generated tree
-                    dirs = os.path.split(l)
-                    while dirs[0] != "/":
-                        if os.listdir(dirs[0]):
-                            break
-                        shutil.rmtree(dirs[0])
-                        dirs = os.path.split(dirs[0])
-
-        # Move files
-        file_list = []
-        for src in src_list:
-            stripped = src.replace(source_dir, "")
-            stripped = self.remove_slash(stripped)
-            dst = os.path.dirname(path(env["ZOE_HOME"], stripped))
+            # Files not present in the update are removed on commit
+            with open(path(txn["stage"], "remove"), "w") as rfile:
+                for f in self.list_files(name):
+                    if not os.path.isfile(path(source_dir, f)):
+                        rfile.write("%s\n" % f)
+
+        with os.scandir(source_dir) as entries:
+            subdirs = [e.name for e in entries if e.name not in [".git", "zam"]
+                and e.is_dir(follow_symlinks=False)]
+
+        # Directories already created and errors found by the copy threads
+        created = set()
+        errors = []
+        slots = threading.BoundedSemaphore(COPY_QUEUE)
+
+        def copied(future):
+            slots.release()
+            if future.exception():
+                errors.append(future.exception())
+
+        flist = self.staged_path(txn, path(ZAM_INFO, name + ".list"))
+
+        with open(flist, "w+") as dfile, \
+                ThreadPoolExecutor(max_workers=COPY_WORKERS) as pool:
+            for d in subdirs:
+                for f in self.scan_files(d, source_dir):
+                    dst = path(stage, f)
+
+                    parent = os.path.dirname(dst)
+                    if parent not in created:
+                        os.makedirs(parent, exist_ok=True)
+                        created.add(parent)
+
+                    # Wait if too many copies are queued
+                    slots.acquire()
+
+                    if local:
+                        hardlink = f not in copies and not f.startswith(
+                            ("cmdproc", "mailproc"))
+                        future = pool.submit(self.link_file,
+                            path(source_dir, f), dst, hardlink,
+                            path(env["ZOE_HOME"], f))
+                    else:
+                        # The cloned tree is removed afterwards anyway
+                        future = pool.submit(os.replace,
+                            path(source_dir, f), dst)
+
+                    future.add_done_callback(copied)
+
+                    dfile.write("%s\n" % f)
+
+        if errors:
+            raise errors[0]
+
+    def multiparse(self, parser, keys):
+        """ Obtain several elements from the parser, identified by the
+            list of keys.
 
+            Values are returned in the order specified by the keys list.
+        """
+        result = []
+        for k in keys:
+            result.append(parser.get(k))
+
+        return result
+
+    def notify(self, message, user, dst):
+        """ Send a feedback message outside of a message handler. """
+        fb = self.feedback(message, user, dst)
+
+        if fb:
+            self.sendbus(fb.msg())
+
+    def owned_files(self):
+        """ Obtain the set of files that belong to an agent, according to
+            the file lists and config file lists in etc/zam/info.
+        """
+        owned = set()
+
+        with os.scandir(ZAM_INFO) as entries:
+            for entry in entries:
+                if not entry.name.endswith((".list", ".conffiles")):
+                    continue
+
+                with open(entry.path, "r") as flist:
+                    owned.update(f for f in flist.read().splitlines() if f)
+
+        return owned
+
+    def paginate(self, lines, page):
+        """ Join the lines of the given page of a report, adding the page
+            number if there is more than one.
+        """
+        try:
+            page = max(int(page), 1)
+        except (TypeError, ValueError):
+            page = 1
+
+        pages = (len(lines) + PAGE_SIZE - 1) // PAGE_SIZE
+        page = min(page, pages)
+        start = (page - 1) * PAGE_SIZE
+
+        msg = "\n".join(lines[start:start + PAGE_SIZE])
+        if pages > 1:
+            msg += "\n" + _("Page %(page)d of %(pages)d") % {
+                "page": page, "pages": pages}
+
+        return msg
+
+    def profile_call(self, f, *args, **kwargs):
+        """ Call a message handler within the active profiling session. """
+        session = self.profiler
+        session["depth"] += 1
+        outer = session["depth"] == 1
+
+        if outer and session["mode"] == "cpu":
+            session["profile"].enable()
+
+        started = time.time()
+
+        try:
+            return f(self, *args, **kwargs)
+
+        finally:
+            session["depth"] -= 1
+
+            if outer:
+                if session["mode"] == "cpu":
+                    session["profile"].disable()
+
+                session["calls"].append((f.__name__, time.time() - started))
+                session["remaining"] -= 1
+
+                if session["remaining"] <= 0 or \
+                        time.time() > session["deadline"]:
+                    self.notify(_("Profile written to %s") %
+                        self.finish_profile(), session["sender"],
+                        session["src"])
+
+    def parse_info(self, info_path):
+        """ When installing an agent, parse the information file and return
+            a dictionary with the information.
+
+            In the case the specific field is not present, give value None
+            and continue.
+        """
+        with open(info_path) as ifile:
+            return self.parse_info_string(ifile.read())
+
+    def parse_info_string(self, content):
+        """ Parse the contents of an information file. See parse_info(). """
+        from configparser import ConfigParser
+
+        info = ConfigParser()
+        # Add a dummy section
+        info.read_string(StringIO("[info]\n%s" % content).read())
+
+        data = {
+            "agent": None,
+            "version": None,
+            "license": None,
+            "maintainer": None,
+            "script": None,
+            "topics": None,
+            "description": None
+        }
+
+        for key in info["info"].keys():
+            data[key] = info["info"][key]
+
+        return data
+
+    def pid_files(self):
+        """ Scan ZOE_VAR for agent .pid files.
+
+            Returns a dictionary mapping agent names to (pid, start time)
+            tuples, where the start time is the modification time of the
+            .pid file. Unreadable files have a pid of None.
+        """
+        pids = {}
+        try:
+            entries = os.scandir(env["ZOE_VAR"])
+        except OSError:
+            return pids
+
+        with entries:
+            for entry in entries:
+                if not entry.name.endswith(".pid") or not entry.is_file():
+                    continue
+
+                try:
+                    with open(entry.path) as pfile:
+                        pid = int(pfile.read().strip())
+                except (OSError, ValueError):
+                    pid = None
+
+                try:
+                    started = entry.stat().st_mtime
+                except OSError:
+                    started = time.time()
+
+                pids[entry.name[:-len(".pid")]] = (pid, started)
+
+        return pids
+
+    def prefetch(self, settings):
+        """ Fetch the sources of the installed agents into var/zam/staged,
+            keeping track of those that have a newer version available.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        alist = self.read_list()
+        agents = [(name, alist[name]["source"], alist[name]["version"])
+            for name in alist.sections()
+            if self.installed(name, alist) and alist[name].get("source") and
+            not self.local_source(alist[name]["source"])]
+
+        self.logger.debug("Prefetching %d agents" % len(agents))
+
+        with ThreadPoolExecutor(
+                max_workers=max(settings.getint("workers"), 1)) as pool:
+            for name, source, version in agents:
+                pool.submit(self.prefetch_agent, settings, name, source,
+                    version)
+
+    def prefetch_agent(self, settings, name, source, version):
+        """ Fetch the source of an agent into var/zam/staged/name.
+
+            An existing tree of the same source is updated with only the new
+            commits, otherwise it is cloned again.
+        """
+        import shutil
+        import subprocess
+        from semantic_version import Version
+
+        stage = path(ZAM_STAGE, name)
+
+        lock = self.staged_lock(name)
+        if not lock.acquire(blocking=False):
+            # Being used by an update
+            return
+
+        try:
+            with open(os.devnull, "w") as null:
+                if self.staged_source(stage) == source:
+                    code = subprocess.call(self.git_command(settings,
+                        "fetch", "--quiet", "origin"), cwd=stage,
+                        stdout=null, stderr=null)
+                    if code == 0:
+                        code = subprocess.call(self.git_command(settings,
+                            "reset", "--hard", "--quiet", "@{upstream}"),
+                            cwd=stage, stdout=null, stderr=null)
+
+                else:
+                    shutil.rmtree(stage, ignore_errors=True)
+                    os.makedirs(ZAM_STAGE, exist_ok=True)
+                    code = subprocess.call(self.git_command(settings,
+                        "clone", "--quiet", source, stage),
+                        stdout=null, stderr=null)
+
+            if code != 0:
+                self.logger.info("Could not prefetch source: %s" % source)
+                shutil.rmtree(stage, ignore_errors=True)
+                self.staged.pop(name, None)
+                return
+
+            a_info = self.parse_info(path(stage, "zam", "info"))
+
+            if a_info["version"] and (not version or
+                    Version(a_info["version"]) > Version(version)):
+                self.logger.info("Version %s of '%s' is ready to be applied"
+                    % (a_info["version"], name))
+                self.staged[name] = (source, a_info["version"])
+
+            else:
+                self.staged.pop(name, None)
+
+        except Exception as e:
+            self.logger.info("Error prefetching '%s': %s" % (name, e))
+            self.staged.pop(name, None)
+
+        finally:
+            lock.release()
+
+    def proc_stats(self, pid):
+        """ Read the CPU time (in clock ticks), resident memory (in bytes)
+            and number of open files of a process from /proc.
+
+            Returns None if the process cannot be read.
+        """
+        try:
+            with open("/proc/%d/stat" % pid, "r") as sfile:
+                # The command name may contain spaces and parentheses
+                fields = sfile.read().rsplit(")", 1)[1].split()
+
+            # utime, stime and rss are the fields 14, 15 and 24
+            ticks = int(fields[11]) + int(fields[12])
+            rss = int(fields[21]) * os.sysconf("SC_PAGE_SIZE")
+
+        except (OSError, ValueError, IndexError):
+            return None
+
+        try:
+            fds = len(os.listdir("/proc/%d/fd" % pid))
+        except OSError:
+            # Owned by another user
+            fds = None
+
+        return ticks, rss, fds
+
+    def read_conf(self):
+        """ Read the Zoe configuration file located in etc/zoe.conf. """
+        from configparser import ConfigParser
+
+        conf = ConfigParser()
+        conf.read(ZCONF_PATH)
+
+        return conf
+
+    def read_list(self):
+        """ Read the agent list.
+
+            Returns ConfigParser object.
+        """
+        from configparser import ConfigParser
+
+        alist = ConfigParser()
+        alist.read(ZAM_LIST)
+
+        return alist
+
+    def read_manifest(self, name):
+        """ Read the manifest of an agent.
+
+            Returns a dictionary mapping relative paths to dictionaries with
+            the 'kind' ('f' for regular files, 'c' for config files), 'hash',
+            'size', 'mode' and 'mtime' of each file, or None if the agent
+            has no manifest.
+        """
+        manifest = {}
+
+        try:
+            with open(path(ZAM_INFO, name + ".manifest"), "r") as mfile:
+                for line in mfile.read().splitlines():
+                    fields = line.split(" ", 5)
+                    if len(fields) != 6:
+                        continue
+
+                    manifest[fields[5]] = {
+                        "kind": fields[0],
+                        "hash": fields[1],
+                        "size": int(fields[2]),
+                        "mode": int(fields[3], 8),
+                        "mtime": int(fields[4])
+                    }
+
+        except OSError:
+            return None
+
+        return manifest
+
+    def read_settings(self):
+        """ Read zam's settings from etc/zam/zam.conf, using the default
+            values for those that are not present.
+        """
+        from configparser import ConfigParser
+
+        settings = ConfigParser()
+        settings.read_dict(SETTINGS_DEFAULTS)
+        settings.read(ZAM_SETTINGS)
+
+        return settings
+
+    def record(self, name, op, result):
+        """ Store the result of the last operation performed on an agent. """
+        self.ops[name] = (op, result, time.time())
+        self.save_ops()
+
+    def recover_transactions(self, name=None):
+        """ Finish the transactions interrupted by a stop of zam (or only
+            the one of the given agent).
+
+            Committed transactions are rolled forward, any other is rolled
+            back by discarding its staged changes, as nothing was modified
+            yet.
+        """
+        try:
+            entries = os.listdir(ZAM_JOURNAL)
+        except OSError:
+            # Nothing to recover
+            return
+
+        agents = set(e[:-len(".json")] if e.endswith(".json") else e
+            for e in entries if not e.endswith(".new"))
+
+        for agent in [a for a in agents if name in [None, a]]:
             try:
-                os.makedirs(dst)
-            except:
-                # Tree already exists?
-                pass
+                with open(path(ZAM_JOURNAL, agent + ".json"), "r") as jfile:
+                    txn = json.load(jfile)
+
+            except (OSError, ValueError):
+                # Staging tree left before the journal was written
+                txn = {"name": agent, "op": None, "state": "prepare",
+                    "stage": path(ZAM_JOURNAL, agent)}
+
+            if txn["state"] != "commit":
+                self.end_transaction(txn)
+
+                if txn["op"]:
+                    self.record(agent, txn["op"], "rolled back")
+                continue
+
+            self.apply_transaction(txn)
+            self.end_transaction(txn)
+
+            if txn["op"] != "remove":
+                # Hashes of the files that were put in place
+                try:
+                    self.write_manifest(agent, self.list_files(agent))
+                except OSError:
+                    pass
+
+            self.record(agent, txn["op"], "rolled forward")
+
+    def repair_files(self, name, alist, files):
+        """ Restore the given files of an agent from its source.
+
+            The source must provide the same version that is installed,
+            otherwise nothing is restored.
+
+            Returns the lists of restored files and of files that could not
+            be restored, or None on error.
+        """
+        import shutil
+
+        self.clean()
+
+        temp = path(ZAM_TEMP, name)
+        if self.fetch(name, alist[name]["source"]) != 0:
+            self.logger.info("Could not fetch source: %s" %
+                alist[name]["source"])
+            self.clean()
+            return None
+
+        a_info = self.parse_info(path(temp, "zam", "info"))
+        if a_info["version"] != alist[name]["version"]:
+            self.logger.info("Version of '%s' in source differs from the "
+                "installed one" % name)
+            self.clean()
+            return None
+
+        manifest = self.read_manifest(name)
+
+        repaired = []
+        failed = []
+        for f in files:
+            src_file = path(temp, f)
+            dst = path(env["ZOE_HOME"], f)
+
+            if not os.path.isfile(src_file):
+                self.logger.info("'%s' not found in source" % f)
+                failed.append(f)
+                continue
+
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            if os.path.islink(temp):
+                # Local source, only hard linked if the mode is the same
+                self.link_file(src_file, dst, stat.S_IMODE(
+                    os.stat(src_file).st_mode) == manifest[f]["mode"])
+            else:
+                shutil.copy(src_file, dst)
 
-            shutil.copy(src, dst)
-            file_list.append(stripped)
+            # Hard linked files are the source itself
+            if not os.path.samefile(src_file, dst):
+                os.chmod(dst, manifest[f]["mode"])
+            repaired.append(f)
 
-        return file_list
+            self.logger.debug("Restored %s" % dst)
 
-    def multiparse(self, parser, keys):
-        """ Obtain several elements from the parser, identified by the
-            list of keys.
+        # Refresh the manifest with the restored files only, the rest are
+        # still reported by verify
+        self.update_manifest(name, repaired)
 
-            Values are returned in the order specified by the keys list.
-        """
-        result = []
-        for k in keys:
-            result.append(parser.get(k))
+        self.clean()
+        self.record(name, "repair", "incomplete" if failed else "ok")
 
-        return result
+        return repaired, failed
 
-    def parse_info(self, info_path):
-        """ When installing an agent, parse the information file and return
-            a dictionary with the information.
+    def registry_index(self):
+        """ Obtain the registry of available agents and its search index.
 
-            In the case the specific field is not present, give value None
-            and continue.
+            The index is a sorted list of (token, name) pairs for prefix
+            searches. Both are cached and only rebuilt when the registry
+            file is modified.
         """
-        info = ConfigParser()
-        # Add a dummy section
-        info.read_string(StringIO(
-            "[info]\n%s" % open(info_path).read()).read())
+        from configparser import ConfigParser
 
-        data = {
-            "agent": None,
-            "version": None,
-            "license": None,
-            "maintainer": None,
-            "script": None,
-            "topics": None,
-            "description": None
-        }
+        try:
+            st = os.stat(ZAM_REGISTRY)
+            key = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            key = None
 
-        for key in info["info"].keys():
-            data[key] = info["info"][key]
+        if key == self.registry_key:
+            return self.registry, self.registry_tokens
 
-        return data
+        rconf = ConfigParser(interpolation=None)
+        rconf.read(ZAM_REGISTRY)
 
-    def read_conf(self):
-        """ Read the Zoe configuration file located in etc/zoe.conf. """
-        conf = ConfigParser()
-        conf.read(ZCONF_PATH)
+        registry = {}
+        tokens = set()
+        for name in rconf.sections():
+            registry[name] = dict(rconf[name])
 
-        return conf
+            words = self.tokenize(" ".join([name, name.replace("_", " "),
+                rconf[name].get("description", ""),
+                rconf[name].get("topics", "")]))
+            tokens.update((w, name) for w in words)
 
-    def read_list(self):
-        """ Read the agent list.
+        self.registry = registry
+        self.registry_tokens = sorted(tokens)
+        self.registry_key = key
+        self.save_state()
 
-            Returns ConfigParser object.
+        return registry, self.registry_tokens
+
+    def remove_file(self, fpath):
+        """ Remove a file and any directories left empty after it, up to
+            ZOE_HOME.
         """
-        alist = ConfigParser()
-        alist.read(ZAM_LIST)
+        try:
+            os.remove(fpath)
+        except OSError:
+            # Nothing to remove?
+            return
 
-        return alist
+        parent = os.path.dirname(fpath)
+        while parent != env["ZOE_HOME"] and parent != "/":
+            try:
+                os.rmdir(parent)
+            except OSError:
+                # Not empty
+                break
+
+            parent = os.path.dirname(parent)
 
     def remove_slash(self, path):
         """ Remove initial slash (/) from path (if any). """
@@ -854,6 +3208,51 @@ class AgentManager:
 
         return new_path
 
+    def restart_waves(self, names, settings, sender, src):
+        """ Restart agents in waves of at most 'wave' agents, waiting
+            'delay' seconds before checking their health.
+
+            Stops at the first wave in which an agent is not running.
+        """
+        wave = max(settings.getint("wave"), 1)
+        delay = settings.getint("delay")
+
+        for i in range(0, len(names), wave):
+            batch = names[i:i + wave]
+
+            for name in batch:
+                self.run_launcher("restart-agent", name)
+                self.record(name, "restart", "ok")
+
+            time.sleep(delay)
+
+            failed = [name for name in batch if not self.healthy(name)]
+            if failed:
+                for name in failed:
+                    self.record(name, "restart", "not running")
+
+                self.logger.info("Rollout stopped, not running: %s" %
+                    " ".join(failed))
+
+                return self.notify(_("Update stopped, these agents are not "
+                    "running after the restart: %s") % " ".join(failed),
+                    sender, src)
+
+        self.logger.info("Restarted %d agents" % len(names))
+
+        return self.notify(_("Restarted %d updated agents") % len(names),
+            sender, src)
+
+    def run_launcher(self, action, name):
+        """ Run an action of the Zoe launcher script on an agent. """
+        import subprocess
+
+        # Redirect stdout and stderr to zam's log
+        log_file = open(path(env["ZOE_LOGS"], "zam.log"), "a")
+
+        return subprocess.Popen([ZOE_LAUNCHER, action, name],
+            stdout=log_file, stderr=log_file, cwd=env["ZOE_HOME"])
+
     def running(self, name):
         """ Check if an agent is running. """
         # We depend on the .pid files here
@@ -864,6 +3263,117 @@ class AgentManager:
 
         return False
 
+    def same_file(self, st, current):
+        """ Check if a file of a local source is already installed, given
+            the stat results of both.
+
+            Only the execute permission of the owner may differ, as scripts
+            are made executable when installed.
+        """
+        return os.path.samestat(st, current) or (
+            current.st_size == st.st_size and
+            current.st_mtime_ns == st.st_mtime_ns and
+            current.st_mode | stat.S_IEXEC == st.st_mode | stat.S_IEXEC)
+
+    def sample_usage(self, settings):
+        """ Store a sample of the CPU usage, resident memory and open files
+            of each running agent, keeping the last ones in a ring buffer.
+        """
+        samples = max(settings.getint("samples"), 1)
+        clock = os.sysconf("SC_CLK_TCK")
+        now = time.time()
+
+        running = {}
+        for name, (pid, started) in self.pid_files().items():
+            stats = self.proc_stats(pid) if self.alive(pid) else None
+            if stats:
+                running[name] = (pid, stats)
+
+        # Agents that stopped
+        for name in [n for n in self.usage_samples if n not in running]:
+            del self.usage_samples[name]
+
+        for name, (pid, (ticks, rss, fds)) in running.items():
+            sampled = self.usage_samples.get(name)
+
+            cpu = None
+            if sampled and sampled["pid"] == pid and now > sampled["time"]:
+                cpu = 100.0 * (ticks - sampled["ticks"]) / clock / (
+                    now - sampled["time"])
+
+            if not sampled or sampled["samples"].maxlen != samples:
+                sampled = {"samples": deque(
+                    sampled["samples"] if sampled else [], maxlen=samples)}
+
+            sampled.update({"pid": pid, "ticks": ticks, "time": now})
+            sampled["samples"].append((now, cpu, rss, fds))
+
+            self.usage_samples[name] = sampled
+
+    def save_ops(self):
+        """ Save the last operation performed on each agent for the next
+            run.
+
+            Kept apart from the state saved by save_state(), which is much
+            larger and only changes when the indexes are rebuilt.
+        """
+        try:
+            # Operations may be recorded from several threads
+            with self.ops_lock:
+                os.makedirs(ZAM_TEMP, exist_ok=True)
+
+                with open(ZAM_OPS + ".new", "w") as ofile:
+                    json.dump(dict(self.ops), ofile)
+
+                os.replace(ZAM_OPS + ".new", ZAM_OPS)
+
+        except OSError as e:
+            self.logger.debug("Could not save operations: %s" % e)
+
+    def save_state(self):
+        """ Save the agent index and registry for the next run. """
+        state = {
+            "index": self.index,
+            "index_key": self.index_key,
+            "registry": self.registry,
+            "registry_tokens": self.registry_tokens,
+            "registry_key": self.registry_key
+        }
+
+        try:
+            os.makedirs(ZAM_TEMP, exist_ok=True)
+
+            with open(ZAM_STATE + ".new", "w") as sfile:
+                json.dump(state, sfile)
+
+            os.replace(ZAM_STATE + ".new", ZAM_STATE)
+
+        except OSError as e:
+            self.logger.debug("Could not save state: %s" % e)
+
+    def scan_files(self, rel_dir, root=None):
+        """ Walk a directory relative to 'root' (ZOE_HOME by default) using
+            os.scandir, yielding the paths of the files found relative to
+            'root'.
+        """
+        root = root or env["ZOE_HOME"]
+        pending = [rel_dir]
+
+        while pending:
+            current = pending.pop()
+            try:
+                entries = os.scandir(path(root, current))
+            except OSError:
+                continue
+
+            with entries:
+                for entry in entries:
+                    rel = path(current, entry.name)
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(rel)
+                    else:
+                        yield rel
+
     def set_locale(self, user):
         """ Set the locale for messages based on the locale of the sender.
 
@@ -874,13 +3384,225 @@ class AgentManager:
             locale = ZOE_LOCALE
 
         else:
+            from zoe.models.users import Users
+
             conf = Users().subject(user)
             locale = conf.get("locale", ZOE_LOCALE)
 
-        lang = gettext.translation("zam", localedir=LOCALEDIR,
-            languages=[locale,])
+        if locale == self.locale:
+            return
+
+        self.translation(locale).install()
+        self.locale = locale
+
+    def stage_executables(self, name, a_info, txn):
+        """ Make the script of an agent and its cmdproc and mailproc
+            scripts executable in the staging tree of a transaction.
+
+            Raises FileNotFoundError if one of them is not in the source.
+        """
+        stage = path(txn["stage"], "files")
+
+        # There may be cases where an agent is only formed by natural
+        # language files, so this key may not be present.
+        scripts = [path("agents", name, a_info["script"])
+            ] if a_info["script"] else []
+
+        scripts += [f for f in self.list_files(name, txn)
+            if f.startswith("cmdproc") or f.startswith("mailproc")]
+
+        # Local sources only stage the files that changed
+        local = os.path.islink(path(ZAM_TEMP, name))
+
+        for f in scripts:
+            df = path(stage, f)
+            if not os.path.isfile(df):
+                if local and os.path.isfile(path(ZAM_TEMP, name, f)):
+                    # Not changed since it was installed
+                    continue
+
+                raise FileNotFoundError("'%s' not found in source" % f)
+
+            self.make_executable(df)
+
+    def staged_lock(self, name):
+        """ Obtain the lock that protects the prefetched tree of an agent. """
+        with self.stage_lock:
+            return self.stage_locks.setdefault(name, threading.Lock())
+
+    def staged_path(self, txn, fpath):
+        """ Obtain the path in the staging tree of a transaction of a
+            file of ZOE_HOME other than the agent files (lists and
+            configuration), creating its directory.
+        """
+        staged = path(txn["stage"], "meta",
+            os.path.relpath(fpath, env["ZOE_HOME"]))
+        os.makedirs(os.path.dirname(staged), exist_ok=True)
+
+        return staged
+
+    def staged_source(self, stage):
+        """ Obtain the source from which a checkout (such as a prefetched
+            tree) was cloned, or None if it is not a git checkout or has no
+            origin.
+        """
+        import subprocess
+
+        try:
+            # Not from the repository ZOE_HOME may be in
+            return subprocess.check_output(["git", "config", "--file",
+                path(stage, ".git", "config"), "--get", "remote.origin.url"],
+                stderr=subprocess.DEVNULL).decode().strip()
+
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def start_watch(self, name, source):
+        """ Start watching the local source of an agent for changes.
+
+            inotify is used if the inotify_simple module is available,
+            otherwise the tree is polled by watch_tick().
+
+            Returns False if the source is not a local directory.
+        """
+        local = self.local_source(source)
+        if not local:
+            return False
+
+        watch = {"path": local, "changed": None, "signature": None}
+
+        try:
+            import inotify_simple
+
+        except ImportError:
+            watch["signature"] = self.tree_signature(local)
+            self.watches[name] = watch
+            return True
+
+        self.watches[name] = watch
+        threading.Thread(target=self.watch_events, args=(name, watch),
+            daemon=True).start()
+
+        return True
+
+    def sync_files(self, name, a_info):
+        """ Stage the files of a fetched update of an agent.
+
+            Runs the preupd script, stages the files and the new file list
+            and makes the scripts executable.
+
+            Returns the transaction of the update, see finish_update().
+        """
+        import subprocess
+
+        temp = path(ZAM_TEMP, name)
+
+        # PREUPDATE
+        preupd = path(temp, "zam", "preupd")
+        if os.path.isfile(preupd):
+            proc = subprocess.call([self.hook_script(name, preupd), ])
+
+            self.logger.debug("Ran preupd script, got code %i" % proc)
+
+        txn = self.begin_transaction(name, "update")
+
+        try:
+            # Stage files and agent file list
+            self.move_files(name, txn, True)
+            self.stage_executables(name, a_info, txn)
+
+        except:
+            # Nothing was changed yet
+            self.end_transaction(txn)
+            raise
+
+        return txn
+
+    def sync_tree(self, root):
+        """ Flush the files and directories of a tree to disk, without
+            waiting for the rest of the filesystem (as os.sync() does).
+
+            Files are synced in batches by a pool of threads, so that their
+            writes are waited for at the same time.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        def entries():
+            for parent, subdirs, files in os.walk(root):
+                yield parent
+                for f in files:
+                    yield path(parent, f)
+
+        def fsync(fpath):
+            if os.path.islink(fpath):
+                # Only the directory entry, synced with the directory
+                return
+
+            fd = os.open(fpath, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        paths = entries()
+
+        with ThreadPoolExecutor(max_workers=COPY_WORKERS) as pool:
+            while True:
+                batch = list(itertools.islice(paths, HASH_BATCH))
+                if not batch:
+                    break
+
+                list(pool.map(fsync, batch))
+
+    def take_staged(self, name, source, dst):
+        """ Link the prefetched source of an agent into 'dst', if a newer
+            version from the same source is ready.
+
+            The checkout is kept, so that the next prefetch only fetches the
+            new commits.
+
+            Returns True if the tree was linked.
+        """
+        import shutil
+
+        if self.staged.get(name, (None,))[0] != source:
+            return False
+
+        lock = self.staged_lock(name)
+        if not lock.acquire(blocking=False):
+            # Still being fetched
+            return False
+
+        try:
+            self.link_tree(path(ZAM_STAGE, name), dst)
+            del self.staged[name]
+
+        except OSError:
+            shutil.rmtree(dst, ignore_errors=True)
+            return False
+
+        finally:
+            lock.release()
+
+        return True
+
+    def tokenize(self, text):
+        """ Split text into lowercase words for the registry index. """
+        return [w for w in re.split(r"[^\w]+", text.lower()) if w]
+
+    def translation(self, locale):
+        """ Obtain the translation for a locale.
+
+            Catalogs are only parsed once.
+        """
+        lang = self.translations.get(locale)
 
-        lang.install()
+        if lang is None:
+            lang = gettext.translation("zam", localedir=LOCALEDIR,
+                languages=[locale,])
+            self.translations[locale] = lang
+
+        return lang
 
     def topics_install(self, agent, topics, conf=None):
         """ Set the topics an agent listens to DURING INSTALLATION.
@@ -941,12 +3663,330 @@ class AgentManager:
 
         return zconf
 
-    def write_conf(self, zconf):
-        """ Write Zoe configuration into etc/zoe.conf. """
-        with open(ZCONF_PATH, 'w') as configfile:
+    def tree_signature(self, root, skip=[".git"]):
+        """ Summarize the files of a directory (except those in 'skip') by
+            their number, sizes and modification times, to detect changes
+            without reading them.
+        """
+        count = size = mtime = 0
+        pending = [root]
+
+        while pending:
+            try:
+                entries = os.scandir(pending.pop())
+            except OSError:
+                continue
+
+            with entries:
+                for entry in [e for e in entries if e.name not in skip]:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                        continue
+
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+
+                    count += 1
+                    size += st.st_size
+                    mtime += st.st_mtime_ns
+
+        return count, size, mtime
+
+    def update_manifest(self, name, files):
+        """ Refresh the entries of the given files in the manifest of an
+            agent, keeping the rest as they were.
+        """
+        manifest = self.read_manifest(name)
+        if manifest is None or not files:
+            return
+
+        hashes = self.hash_files(path(env["ZOE_HOME"], f) for f in files)
+
+        for f in files:
+            dst = path(env["ZOE_HOME"], f)
+            st = os.stat(dst)
+            manifest[f].update({"hash": hashes[dst], "size": st.st_size,
+                "mode": stat.S_IMODE(st.st_mode), "mtime": st.st_mtime_ns})
+
+        mpath = path(ZAM_INFO, name + ".manifest")
+        with open(mpath + ".new", "w") as mfile:
+            for f, entry in manifest.items():
+                mfile.write("%s %s %d %o %d %s\n" % (entry["kind"],
+                    entry["hash"], entry["size"], entry["mode"],
+                    entry["mtime"], f))
+
+        os.replace(mpath + ".new", mpath)
+
+    def verify_files(self, names, conffiles=False, full=False):
+        """ Compare the installed files of several agents with their
+            manifests.
+
+            Files are stat'ed first and only those whose size or
+            modification time changed (or every file when 'full' is True)
+            are hashed, all of them in a single thread pool.
+
+            Returns a dictionary mapping each agent name to None, when the
+            agent had no manifest (a new one is written), or to a
+            dictionary with the 'missing', 'modified' and 'mode' files and
+            the changed 'conffiles' (only when 'conffiles' is True).
+        """
+        drift = {}
+        pending = {}
+
+        for name in names:
+            manifest = self.read_manifest(name)
+
+            if manifest is None:
+                # Installed before manifests were stored
+                try:
+                    with open(path(ZAM_INFO, name + ".list"), "r") as flist:
+                        file_list = flist.read().splitlines()
+                except OSError:
+                    file_list = []
+
+                self.write_manifest(name, file_list)
+
+                drift[name] = None
+                continue
+
+            result = {"missing": [], "modified": [], "mode": [],
+                "conffiles": []}
+            drift[name] = result
+
+            for f, entry in manifest.items():
+                if entry["kind"] == "c" and not conffiles:
+                    continue
+
+                dst = path(env["ZOE_HOME"], f)
+                try:
+                    st = os.stat(dst)
+                except OSError:
+                    if entry["kind"] == "c":
+                        result["conffiles"].append(f)
+                    else:
+                        result["missing"].append(f)
+                    continue
+
+                if entry["kind"] == "f" and stat.S_IMODE(
+                        st.st_mode) != entry["mode"]:
+                    result["mode"].append(f)
+
+                if (full or st.st_size != entry["size"] or
+                        st.st_mtime_ns != entry["mtime"]):
+                    pending[dst] = (name, f, entry)
+
+        hashes = self.hash_files(pending.keys())
+
+        for dst, (name, f, entry) in pending.items():
+            if hashes[dst] == entry["hash"]:
+                continue
+
+            if entry["kind"] == "c":
+                drift[name]["conffiles"].append(f)
+            elif f not in drift[name]["mode"]:
+                drift[name]["modified"].append(f)
+
+        return drift
+
+    def warm_up(self):
+        """ Prepare the cached state used by the message handlers: the
+            agent index, the registry, the default translation and the
+            prefetched sources.
+        """
+        started = time.time()
+
+        try:
+            self.agent_index()
+            self.registry_index()
+            self.translation(ZOE_LOCALE)
+            self.load_staged()
+
+            alist = self.read_list()
+            for name in [a for a in alist.sections()
+                    if alist[a].get("watch") == "1"]:
+                self.start_watch(name, alist[name]["source"])
+
+        except Exception as e:
+            self.logger.info("Could not prepare cached state: %s" % e)
+
+        self.logger.debug("State ready in %.3fs" % (time.time() - started))
+
+    def watch_events(self, name, watch):
+        """ Wait for inotify events in the local source of a watched agent,
+            until it is no longer watched.
+        """
+        from inotify_simple import INotify, flags
+
+        mask = (flags.CREATE | flags.DELETE | flags.CLOSE_WRITE |
+            flags.MOVED_FROM | flags.MOVED_TO)
+        dirs = {}
+        inotify = INotify()
+
+        def add(top):
+            for root, subdirs, files in os.walk(top):
+                subdirs[:] = [d for d in subdirs if d != ".git"]
+                try:
+                    dirs[inotify.add_watch(root, mask)] = root
+                except OSError:
+                    # Removed meanwhile or watch limit reached
+                    pass
+
+        try:
+            add(watch["path"])
+
+            while self.watches.get(name) is watch:
+                events = [e for e in inotify.read(timeout=1000)
+                    if e.mask & mask and e.name != ".git"]
+
+                for event in events:
+                    if (event.mask & flags.ISDIR and
+                            event.mask & (flags.CREATE | flags.MOVED_TO) and
+                            event.wd in dirs):
+                        add(path(dirs[event.wd], event.name))
+
+                if events:
+                    watch["changed"] = time.time()
+
+        finally:
+            inotify.close()
+
+    def write_conf(self, zconf, txn=None):
+        """ Write Zoe configuration into etc/zoe.conf, or stage it in the
+            given transaction.
+        """
+        fpath = self.staged_path(txn, ZCONF_PATH) if txn else ZCONF_PATH
+
+        with open(fpath, 'w') as configfile:
             zconf.write(configfile)
 
-    def write_list(self, lparser):
-        """ Write data into agent list. """
-        with open(ZAM_LIST, 'w') as listfile:
+    def write_journal(self, txn):
+        """ Store the state of a transaction in var/zam/journal/name.json
+
+            The file is replaced at once and synced to disk.
+        """
+        jpath = path(ZAM_JOURNAL, txn["name"] + ".json")
+
+        with open(jpath + ".new", "w") as jfile:
+            json.dump(txn, jfile)
+            jfile.flush()
+            os.fsync(jfile.fileno())
+
+        os.replace(jpath + ".new", jpath)
+
+        fd = os.open(ZAM_JOURNAL, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def write_list(self, lparser, txn=None):
+        """ Write data into agent list, or stage it in the given
+            transaction.
+        """
+        fpath = self.staged_path(txn, ZAM_LIST) if txn else ZAM_LIST
+
+        with open(fpath, 'w') as listfile:
             lparser.write(listfile)
+
+    def write_manifest(self, name, file_list):
+        """ Store the hash, size, mode and modification time of the files
+            of an agent, including its config files, in
+            etc/zam/info/name.manifest
+
+            'file_list' may be any iterable, files are hashed in batches.
+        """
+        conffiles = []
+        confpath = path(ZAM_INFO, name + ".conffiles")
+        if os.path.isfile(confpath):
+            with open(confpath, "r") as conflist:
+                conffiles = [c for c in conflist.read().splitlines() if c]
+
+        pending_conf = set(conffiles)
+
+        def entries():
+            for f in file_list:
+                pending_conf.discard(f)
+                yield f, "f"
+
+            # Config files that are not agent files
+            for c in conffiles:
+                if c in pending_conf:
+                    yield c, "c"
+
+        files = entries()
+
+        with open(path(ZAM_INFO, name + ".manifest"), "w+") as mfile:
+            while True:
+                batch = list(itertools.islice(files, HASH_BATCH))
+                if not batch:
+                    break
+
+                hashes = self.hash_files(
+                    path(env["ZOE_HOME"], f) for f, k in batch)
+
+                for f, kind in batch:
+                    dst = path(env["ZOE_HOME"], f)
+                    if hashes[dst] is None:
+                        # Config files may not exist yet
+                        continue
+
+                    st = os.stat(dst)
+                    mfile.write("%s %s %d %o %d %s\n" % (kind, hashes[dst],
+                        st.st_size, stat.S_IMODE(st.st_mode), st.st_mtime_ns,
+                        f))
+
+    def write_metrics(self, fpath):
+        """ Write the disk usage of the installed agents and the last
+            sample of the running ones in the Prometheus text format.
+
+            The file is replaced at once, so it can be read at any time.
+        """
+        index = self.agent_index()
+
+        metrics = {
+            "zam_agent_disk_bytes": ("Disk space used by the agent", []),
+            "zam_agent_files": ("Number of files of the agent", []),
+            "zam_agent_cpu_percent": ("CPU usage of the agent", []),
+            "zam_agent_resident_bytes": ("Resident memory of the agent", []),
+            "zam_agent_open_files": ("Open files of the agent", [])
+        }
+
+        for agent in sorted(a for a in index if index[a]["installed"]):
+            disk = self.disk_usage(agent)
+
+            for kind in ["files", "conf", "cache"]:
+                metrics["zam_agent_disk_bytes"][1].append(
+                    ('agent="%s",kind="%s"' % (agent, kind), disk[kind]))
+            metrics["zam_agent_files"][1].append(
+                ('agent="%s"' % agent, disk["count"]))
+
+            sampled = self.usage_samples.get(agent)
+            if not sampled or not sampled["samples"]:
+                continue
+
+            t, cpu, rss, fds = sampled["samples"][-1]
+            for metric, value in [("zam_agent_cpu_percent", cpu),
+                    ("zam_agent_resident_bytes", rss),
+                    ("zam_agent_open_files", fds)]:
+                if value is not None:
+                    metrics[metric][1].append(('agent="%s"' % agent, value))
+
+        try:
+            with open(fpath + ".new", "w") as mfile:
+                for metric in sorted(metrics):
+                    help_text, values = metrics[metric]
+                    mfile.write("# HELP %s %s\n# TYPE %s gauge\n" % (
+                        metric, help_text, metric))
+
+                    for labels, value in values:
+                        mfile.write("%s{%s} %s\n" % (metric, labels,
+                            round(value, 2) if isinstance(value, float)
+                            else value))
+
+            os.replace(fpath + ".new", fpath)
+
+        except OSError as e:
+            self.logger.info("Could not write metrics to %s: %s" % (fpath,
+                e))
@@ -31,14 +31,33 @@ my $run;
 my $add;
 my $clean;
 my $forget;
+my $gc;
+my $gcapply;
 my $install;
 my $installsrc;
 my $launch;
+my $profile;
+my $profilememory;
+my $profilestop;
 my $purge;
+my $registry;
+my $registrypath;
 my $remove;
 my $restart;
+my $search;
+my $status;
+my $statusagent;
+my $statuspage;
 my $stop;
 my $update;
+my $updateall;
+my $usage;
+my $usageagent;
+my $verify;
+my $verifyagent;
+my $repair;
+my $watch;
+my $watchstop;
 
 my $sender;
 my $src;
@@ -51,14 +70,33 @@ GetOptions("get"                   => \$get,
            "a"                     => \$add,
            "c"                     => \$clean,
            "f"                     => \$forget,
+           "g"                     => \$gc,
+           "ga"                    => \$gcapply,
            "i"                     => \$install,
            "is"                    => \$installsrc,
            "l"                     => \$launch,
+           "pf"                    => \$profile,
+           "pfm"                   => \$profilememory,
+           "pfs"                   => \$profilestop,
            "p"                     => \$purge,
+           "rb"                    => \$registry,
+           "rbp"                   => \$registrypath,
            "r"                     => \$remove,
            "rs"                    => \$restart,
+           "se"                    => \$search,
+           "st"                    => \$status,
+           "sta"                   => \$statusagent,
+           "stp"                   => \$statuspage,
            "s"                     => \$stop,
            "u"                     => \$update,
+           "ua"                    => \$updateall,
+           "us"                    => \$usage,
+           "usa"                   => \$usageagent,
+           "v"                     => \$verify,
+           "va"                    => \$verifyagent,
+           "vr"                    => \$repair,
+           "w"                     => \$watch,
+           "ws"                    => \$watchstop,
            "string=s"              => \@strings);
 
 if ($get) {
@@ -69,22 +107,60 @@ if ($get) {
   &clean;
 } elsif ($run and $forget) {
   &forget;
+} elsif ($run and $gc) {
+  &gc;
+} elsif ($run and $gcapply) {
+  &gc_apply;
 } elsif ($run and $install) {
   &install;
 } elsif ($run and $installsrc) {
   &install_source;
 } elsif ($run and $launch) {
   &launch;
+} elsif ($run and $profile) {
+  &profile;
+} elsif ($run and $profilememory) {
+  &profile_memory;
+} elsif ($run and $profilestop) {
+  &profile_stop;
 } elsif ($run and $purge) {
   &purge;
+} elsif ($run and $registry) {
+  &registry;
+} elsif ($run and $registrypath) {
+  &registry_path;
 } elsif ($run and $remove) {
   &remove;
 } elsif ($run and $restart) {
   &restart;
+} elsif ($run and $search) {
+  &search;
+} elsif ($run and $status) {
+  &status;
+} elsif ($run and $statusagent) {
+  &status_agent;
+} elsif ($run and $statuspage) {
+  &status_page;
 } elsif ($run and $stop) {
   &stop;
 } elsif ($run and $update) {
   &update;
+} elsif ($run and $updateall) {
+  &update_all;
+} elsif ($run and $usage) {
+  &usage;
+} elsif ($run and $usageagent) {
+  &usage_agent;
+} elsif ($run and $verify) {
+  &verify;
+} elsif ($run and $verifyagent) {
+  &verify_agent;
+} elsif ($run and $repair) {
+  &repair;
+} elsif ($run and $watch) {
+  &watch;
+} elsif ($run and $watchstop) {
+  &watch_stop;
 }
 
 #
@@ -94,26 +170,64 @@ sub get {
   print("--a add /the agent <string> from <string>\n");
   print("--c clean the temp/temporary directory\n");
   print("--f forget /the agent <string>\n");
+  print("--g find leftovers/garbage\n");
+  print("--ga remove/collect leftovers/garbage\n");
   print("--i install /the agent <string>\n");
   print("--is install /the agent <string> from <string>\n");
   print("--l launch /the agent <string>\n");
+  print("--pf profile /the next <string> messages\n");
+  print("--pfm profile memory /of /the next <string> messages\n");
+  print("--pfs stop profiling\n");
   print("--p purge /the agent <string>\n");
+  print("--rb rebuild /the registry\n");
+  print("--rbp rebuild /the registry from <string>\n");
   print("--r remove/uninstall /the agent <string>\n");
   print("--rs restart /the agent <string>\n");
   print("--s stop /the agent <string>\n");
+  print("--se search /for /the agent/agents <string>\n");
+  print("--st status /of /the agents\n");
+  print("--sta status /of /the agent <string>\n");
+  print("--stp status /of /the agents page <string>\n");
   print("--u update /the agent <string>\n");
+  print("--ua update all /the agents\n");
+  print("--us usage /of /the agents\n");
+  print("--usa usage /of /the agent <string>\n");
+  print("--v verify/check /the agents\n");
+  print("--va verify/check /the agent <string>\n");
+  print("--vr repair /the agent <string>\n");
+  print("--w watch /the agent <string>\n");
+  print("--ws stop watching /the agent <string>\n");
 
   print("--a añade /el agente <string> desde <string>\n");
   print("--c limpia el directorio temp/temporal\n");
   print("--f olvida /el agente <string>\n");
+  print("--g busca /los restos/residuos\n");
+  print("--ga elimina/recoge /los restos/residuos\n");
   print("--i instala /el agente <string>\n");
   print("--is instala /el agente <string> desde <string>\n");
   print("--l lanza /el agente <string>\n");
+  print("--pf perfila /los próximos <string> mensajes\n");
+  print("--pfm perfila /la memoria /de /los próximos <string> mensajes\n");
+  print("--pfs detén /el perfilado\n");
   print("--p purga /el agente <string>\n");
+  print("--rb reconstruye /el registro\n");
+  print("--rbp reconstruye /el registro desde <string>\n");
   print("--r borra/desinstala /el agente <string>\n");
   print("--rs reinicia /el agente <string>\n");
   print("--s para/detén /el agente <string>\n");
+  print("--se busca /el /los agente/agentes <string>\n");
+  print("--st estado /de /los agentes\n");
+  print("--sta estado /del agente <string>\n");
+  print("--stp estado /de /los agentes página <string>\n");
   print("--u actualiza /el agente <string>\n");
+  print("--ua actualiza todos /los agentes\n");
+  print("--us uso /de /los agentes\n");
+  print("--usa uso /del agente <string>\n");
+  print("--v verifica/comprueba /los agentes\n");
+  print("--va verifica/comprueba /el agente <string>\n");
+  print("--vr repara /el agente <string>\n");
+  print("--w vigila /el agente <string>\n");
+  print("--ws deja /de vigilar /el agente <string>\n");
 }
 
 #
@@ -137,6 +251,20 @@ sub forget {
   print("message dst=zam&tag=forget&name=$strings[0]&sender=$sender&src=$src\n");
 }
 
+#
+# Find leftovers
+#
+sub gc {
+  print("message dst=zam&tag=gc&sender=$sender&src=$src\n");
+}
+
+#
+# Remove leftovers
+#
+sub gc_apply {
+  print("message dst=zam&tag=gc&apply=1&sender=$sender&src=$src\n");
+}
+
 #
 # Install an agent
 #
@@ -158,6 +286,27 @@ sub launch {
   print("message dst=zam&tag=launch&name=$strings[0]&sender=$sender&src=$src\n");
 }
 
+#
+# Profile the next messages
+#
+sub profile {
+  print("message dst=zam&tag=profile&messages=$strings[0]&sender=$sender&src=$src\n");
+}
+
+#
+# Profile memory of the next messages
+#
+sub profile_memory {
+  print("message dst=zam&tag=profile&mode=memory&messages=$strings[0]&sender=$sender&src=$src\n");
+}
+
+#
+# Stop profiling
+#
+sub profile_stop {
+  print("message dst=zam&tag=profile&stop=1&sender=$sender&src=$src\n");
+}
+
 #
 # Purge an agent
 #
@@ -165,6 +314,20 @@ sub purge {
   print("message dst=zam&tag=purge&name=$strings[0]&sender=$sender&src=$src\n");
 }
 
+#
+# Rebuild the registry
+#
+sub registry {
+  print("message dst=zam&tag=registry&sender=$sender&src=$src\n");
+}
+
+#
+# Rebuild the registry from a directory
+#
+sub registry_path {
+  print("message dst=zam&tag=registry&path=$strings[0]&sender=$sender&src=$src\n");
+}
+
 #
 # Remove/Uninstall an agent
 #
@@ -180,6 +343,34 @@ sub restart {
 }
 
 
+#
+# Search the registry
+#
+sub search {
+  print("message dst=zam&tag=search&query=$strings[0]&sender=$sender&src=$src\n");
+}
+
+#
+# Status of the agents
+#
+sub status {
+  print("message dst=zam&tag=status&sender=$sender&src=$src\n");
+}
+
+#
+# Status of an agent
+#
+sub status_agent {
+  print("message dst=zam&tag=status&name=$strings[0]&sender=$sender&src=$src\n");
+}
+
+#
+# Status of the agents (page)
+#
+sub status_page {
+  print("message dst=zam&tag=status&page=$strings[0]&sender=$sender&src=$src\n");
+}
+
 #
 # Stop an agent
 #
@@ -193,3 +384,59 @@ sub stop {
 sub update {
   print("message dst=zam&tag=update&name=$strings[0]&sender=$sender&src=$src\n");
 }
+
+#
+# Update all the agents
+#
+sub update_all {
+  print("message dst=zam&tag=update-all&sender=$sender&src=$src\n");
+}
+
+#
+# Show the resources used by the agents
+#
+sub usage {
+  print("message dst=zam&tag=usage&sender=$sender&src=$src\n");
+}
+
+#
+# Show the resources used by an agent
+#
+sub usage_agent {
+  print("message dst=zam&tag=usage&name=$strings[0]&sender=$sender&src=$src\n");
+}
+
+#
+# Verify the installed agents
+#
+sub verify {
+  print("message dst=zam&tag=verify&sender=$sender&src=$src\n");
+}
+
+#
+# Verify an agent
+#
+sub verify_agent {
+  print("message dst=zam&tag=verify&name=$strings[0]&sender=$sender&src=$src\n");
+}
+
+#
+# Repair an agent
+#
+sub repair {
+  print("message dst=zam&tag=verify&name=$strings[0]&repair=1&sender=$sender&src=$src\n");
+}
+
+#
+# Watch an agent
+#
+sub watch {
+  print("message dst=zam&tag=watch&name=$strings[0]&sender=$sender&src=$src\n");
+}
+
+#
+# Stop watching an agent
+#
+sub watch_stop {
+  print("message dst=zam&tag=watch&name=$strings[0]&stop=1&sender=$sender&src=$src\n");
+}
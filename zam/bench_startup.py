@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Zoe Agent Manager - https://github.com/RMed/zoe_agent_manager
+#
+# Copyright (c) 2014 Rafael Medina García <rafamedgar@gmail.com>
+#
+# The MIT License (MIT)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+""" Startup benchmark for zam. Only for development!
+
+Starts zam several times in fresh interpreters against a synthetic
+ZOE_HOME (see loadtest.py) and reports the time spent importing it,
+creating the agent and answering the first messages. Exits with an error
+if the median import plus first message time exceeds the budget.
+
+Must be run from the zam/ directory:
+
+    $ ./bench_startup.py --runs 10 --budget 150
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from os.path import join as path
+
+import loadtest
+
+
+def child():
+    """ Measure a single startup. ZOE_HOME is already set up. """
+    started = time.time()
+
+    bus = loadtest.Bus()
+    loadtest.install_zoe_stub(bus)
+    sys.path.insert(0, path("..", "agents", "zam"))
+
+    import zam
+    imported = time.time()
+
+    agent = zam.AgentManager()
+    created = time.time()
+
+    handlers = {}
+    for attr in dir(agent):
+        method = getattr(agent, attr)
+        for tag in getattr(method, "__zoe__tags__", []):
+            handlers.setdefault(tag, []).append(method)
+
+    msg = "dst=zam&tag=status&sender=admin&src=jabber"
+    loadtest.dispatch(agent, handlers, msg)
+    first = time.time()
+
+    loadtest.dispatch(agent, handlers, msg)
+    second = time.time()
+
+    print(json.dumps({
+        "import": imported - started,
+        "init": created - imported,
+        "first": first - created,
+        "second": second - first
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup benchmark for zam")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--agents", type=int, default=50,
+        help="number of synthetic agents in the list")
+    parser.add_argument("--budget", type=float, default=0,
+        help="maximum median import + first message time, in ms")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child()
+
+    root = tempfile.mkdtemp(prefix="zam-bench-")
+    loadtest.make_home(root, args.agents)
+
+    results = []
+    for _ in range(args.runs):
+        out = subprocess.check_output([sys.executable, __file__, "--child"],
+            env=os.environ)
+        results.append(json.loads(out.decode().splitlines()[-1]))
+
+    # The first run starts without a saved state
+    print("%d runs, %d agents (run 1 without saved state)" % (args.runs,
+        args.agents))
+    print()
+    print("%-8s %9s %9s %9s %9s" % ("", "run 1", "median", "min", "max"))
+
+    for key in ["import", "init", "first", "second"]:
+        values = [r[key] * 1000 for r in results]
+        print("%-8s %7.1fms %7.1fms %7.1fms %7.1fms" % (key, values[0],
+            statistics.median(values), min(values), max(values)))
+
+    total = statistics.median(
+        [(r["import"] + r["init"] + r["first"]) * 1000 for r in results])
+    print()
+    print("startup (import + init + first message): %.1fms" % total)
+
+    shutil.rmtree(root, ignore_errors=True)
+
+    if args.budget and total > args.budget:
+        print("over budget (%.1fms)" % args.budget)
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Zoe Agent Manager - https://github.com/RMed/zoe_agent_manager
+#
+# Copyright (c) 2014 Rafael Medina García <rafamedgar@gmail.com>
+#
+# The MIT License (MIT)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+""" Load test for zam. Only for development!
+
+Runs zam against a synthetic ZOE_HOME, replacing the Zoe server and the
+zoe.deco dispatcher with a local message bus, and replays a mix of
+messages at a target rate. Reports the queueing delay and handler latency
+of each tag, the error rate and the consistency of the files managed by
+zam after the run.
+
+Must be run from the zam/ directory. Requires git and the semantic_version
+package:
+
+    $ ./loadtest.py --rate 5 --duration 60 --mix install:2,status:5,restart:2
+
+Agents are installed with git by default, --local installs them from their
+working directories instead.
+"""
+
+import argparse
+import inspect
+import os
+import queue
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import types
+from configparser import ConfigParser
+from os.path import join as path
+
+# Tags that can be included in the message mix
+TAGS = ["gc", "install", "launch", "purge", "remove", "restart", "status",
+    "stop", "update", "update-all", "verify"]
+
+LAUNCHER = """#!/bin/sh
+# Stand-in for the Zoe launcher: agents are 'sleep' processes
+PID="$ZOE_VAR/$2.pid"
+case "$1" in
+    launch-agent)
+        sleep 3600 > /dev/null 2>&1 &
+        echo $! > "$PID";;
+    stop-agent)
+        kill $(cat "$PID") 2> /dev/null; rm -f "$PID";;
+    restart-agent)
+        kill $(cat "$PID") 2> /dev/null
+        sleep 3600 > /dev/null 2>&1 &
+        echo $! > "$PID";;
+esac
+"""
+
+
+class Parser:
+    """ Stand-in for the message parser passed to zam's handlers. """
+
+    def __init__(self, msg):
+        self._map = {}
+        for pair in msg.split("&"):
+            key, _sep, value = pair.partition("=")
+            self._map[key] = value
+
+    def get(self, key):
+        return self._map.get(key)
+
+
+class Bus:
+    """ Local replacement of the Zoe server.
+
+        Messages for zam are queued with the time they were sent, the rest
+        are counted as outgoing.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.outgoing = 0
+        self.lock = threading.Lock()
+
+    def send(self, msg):
+        if "dst=zam&" in msg + "&":
+            self.queue.put((time.time(), msg))
+        else:
+            with self.lock:
+                self.outgoing += 1
+
+
+def install_zoe_stub(bus):
+    """ Register stand-in zoe, zoe.deco and zoe.models.users modules. """
+    zoe = types.ModuleType("zoe")
+    deco = types.ModuleType("zoe.deco")
+    models = types.ModuleType("zoe.models")
+    users = types.ModuleType("zoe.models.users")
+
+    class MessageBuilder:
+        def __init__(self, fields):
+            self.fields = fields
+
+        def msg(self):
+            return "&".join("%s=%s" % (k, v) for k, v in self.fields.items()
+                if v is not None)
+
+    def Agent(name):
+        def decorate(cls):
+            import logging
+            cls.logger = logging.getLogger(name)
+            cls.sendbus = lambda self, msg: bus.send(msg)
+            return cls
+        return decorate
+
+    class Message:
+        def __init__(self, tags=[]):
+            self.tags = tags
+
+        def __call__(self, f):
+            f.__zoe__tags__ = self.tags
+            return f
+
+    class Timed:
+        def __init__(self, period):
+            self.period = period
+
+        def __call__(self, f):
+            f.__zoe__timed__ = self.period
+            return f
+
+    class Users:
+        def membersof(self, group):
+            return ["admin"]
+
+        def subject(self, user):
+            return {}
+
+    zoe.MessageBuilder = MessageBuilder
+    deco.Agent, deco.Message, deco.Timed = Agent, Message, Timed
+    users.Users = Users
+    zoe.deco, zoe.models, models.users = deco, models, users
+
+    sys.modules.update({"zoe": zoe, "zoe.deco": deco, "zoe.models": models,
+        "zoe.models.users": users})
+
+
+def make_home(root, agents, local=False):
+    """ Create a synthetic ZOE_HOME and the sources of the test agents.
+
+        Agents are installed from bare clones of their sources with git,
+        or straight from the working directories if 'local' is True.
+    """
+    home = path(root, "home")
+    for d in ["agents", "cmdproc", "mailproc", "logs", "var",
+            path("etc", "zam", "info")]:
+        os.makedirs(path(home, d))
+
+    shutil.copytree(path("..", "locale"), path(home, "locale"))
+
+    with open(path(home, "zoe"), "w") as launcher:
+        launcher.write(LAUNCHER)
+    os.chmod(path(home, "zoe"), 0o755)
+
+    with open(path(home, "etc", "zoe.conf"), "w") as zconf:
+        zconf.write("[agent zam]\nport = 30001\n")
+
+    alist = ConfigParser()
+    for i in range(agents):
+        name = "load%d" % i
+        src = path(root, "src", name)
+
+        for d in [path("agents", name), "cmdproc", "zam"]:
+            os.makedirs(path(src, d))
+
+        with open(path(src, "zam", "info"), "w") as info:
+            info.write("agent = %s\nversion = 0.1.0\nscript = %s.py\n"
+                "topics = load t%d\n" % (name, name, i % 3))
+        with open(path(src, "agents", name, name + ".py"), "w") as script:
+            script.write("print('%s')\n" % name)
+        with open(path(src, "cmdproc", name + ".pl"), "w") as cmd:
+            cmd.write("#!/usr/bin/env perl\n")
+
+        subprocess.check_call("git init -q && git add -A && git -c "
+            "user.name=load -c user.email=load@localhost commit -qm load",
+            shell=True, cwd=src)
+
+        if not local:
+            subprocess.check_call(["git", "clone", "-q", "--bare", src,
+                src + ".git"])
+            src += ".git"
+
+        alist[name] = {"source": "file://" + src, "installed": "0",
+            "version": ""}
+
+    with open(path(home, "etc", "zam", "list"), "w") as lfile:
+        alist.write(lfile)
+
+    env = {
+        "ZOE_HOME": home,
+        "ZOE_VAR": path(home, "var"),
+        "ZOE_LOGS": path(home, "logs"),
+        "ZOE_LOCALE": "en",
+        "ZOE_SERVER_HOST": "localhost",
+        "ZOE_SERVER_PORT": "30000"
+    }
+    os.environ.update(env)
+
+    return home
+
+
+def dispatch(agent, handlers, msg):
+    """ Call the handlers of a message the way zoe.deco does. """
+    parser = Parser(msg)
+    tag = parser.get("tag")
+
+    for method in handlers.get(tag, []):
+        params = []
+        for arg in list(inspect.signature(method).parameters):
+            params.append(parser if arg == "parser" else parser.get(arg))
+
+        ret = method(*params)
+        if ret is not None:
+            agent.sendbus(ret.msg())
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def check_consistency(home, reserved):
+    """ Check that the agent list, file lists and zoe.conf agree.
+
+        'reserved' are the entries of var/zam that zam keeps between
+        operations.
+    """
+    problems = []
+
+    alist = ConfigParser()
+    alist.read(path(home, "etc", "zam", "list"))
+    zconf = ConfigParser()
+    zconf.read(path(home, "etc", "zoe.conf"))
+
+    ports = {}
+    for sec in [s for s in zconf.sections() if "port" in zconf[s]]:
+        ports.setdefault(zconf[sec]["port"], []).append(sec)
+    for port, secs in ports.items():
+        if len(secs) > 1:
+            problems.append("port %s used by %s" % (port, ", ".join(secs)))
+
+    topics = {}
+    for sec in [s for s in zconf.sections() if s.startswith("topic ")]:
+        for agent in zconf[sec]["agents"].split():
+            topics.setdefault(agent, []).append(sec)
+
+    for name in [a for a in alist.sections() if a != "zam"]:
+        installed = alist[name]["installed"] == "1"
+        flist = path(home, "etc", "zam", "info", name + ".list")
+
+        if installed != os.path.isfile(flist):
+            problems.append("%s: installed=%s but file list %s" % (name,
+                alist[name]["installed"],
+                "exists" if os.path.isfile(flist) else "is missing"))
+
+        if installed != ("agent " + name in zconf.sections()):
+            problems.append("%s: installed=%s but zoe.conf section %s" % (
+                name, alist[name]["installed"],
+                "exists" if not installed else "is missing"))
+
+        if not installed and name in topics:
+            problems.append("%s: not installed but in %s" % (name,
+                ", ".join(topics[name])))
+
+        if installed and os.path.isfile(flist):
+            with open(flist) as files:
+                for f in files.read().splitlines():
+                    if not os.path.isfile(path(home, f)):
+                        problems.append("%s: missing %s" % (name, f))
+
+    temp = path(home, "var", "zam")
+    if os.path.isdir(temp):
+        for d in [d for d in os.listdir(temp) if d not in reserved]:
+            problems.append("leftover temporary directory var/zam/%s" % d)
+
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for zam")
+    parser.add_argument("--rate", type=float, default=2.0,
+        help="messages per second")
+    parser.add_argument("--duration", type=float, default=30.0,
+        help="seconds during which messages are sent")
+    parser.add_argument("--agents", type=int, default=10,
+        help="number of synthetic agents")
+    parser.add_argument("--mix", default="install:2,status:4,restart:2,"
+        "stop:1,launch:1,update:1,remove:1,verify:1",
+        help="weighted tags to send, as tag:weight pairs")
+    parser.add_argument("--workers", type=int, default=1,
+        help="messages handled at the same time (Zoe handles one)")
+    parser.add_argument("--no-sender", type=float, default=0.5,
+        help="fraction of messages sent without sender, like automation")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--local", action="store_true",
+        help="install the agents from their working directories, not git")
+    parser.add_argument("--keep", action="store_true",
+        help="keep the synthetic ZOE_HOME")
+    args = parser.parse_args()
+
+    rand = random.Random(args.seed)
+
+    mix = []
+    for item in args.mix.split(","):
+        tag, _sep, weight = item.partition(":")
+        if tag not in TAGS:
+            parser.error("unknown tag '%s'" % tag)
+        mix.append((tag, float(weight or 1)))
+
+    root = tempfile.mkdtemp(prefix="zam-load-")
+    home = make_home(root, args.agents, args.local)
+
+    bus = Bus()
+    install_zoe_stub(bus)
+    sys.path.insert(0, path("..", "agents", "zam"))
+
+    started = time.time()
+    import zam
+    import_time = time.time() - started
+
+    agent = zam.AgentManager()
+    handlers = {}
+    for attr in dir(agent):
+        method = getattr(agent, attr)
+        for tag in getattr(method, "__zoe__tags__", []):
+            handlers.setdefault(tag, []).append(method)
+
+    stats = {}
+    errors = []
+    stats_lock = threading.Lock()
+
+    def worker():
+        while True:
+            sent, msg = bus.queue.get()
+            if msg is None:
+                return
+
+            start = time.time()
+            error = None
+            try:
+                dispatch(agent, handlers, msg)
+            except Exception:
+                error = traceback.format_exc()
+            end = time.time()
+
+            tag = Parser(msg).get("tag")
+            with stats_lock:
+                st = stats.setdefault(tag, {"delay": [], "latency": [],
+                    "errors": 0})
+                st["delay"].append(start - sent)
+                st["latency"].append(end - start)
+                if error:
+                    st["errors"] += 1
+                    errors.append("%s\n%s" % (msg, error))
+
+            bus.queue.task_done()
+
+    workers = [threading.Thread(target=worker, daemon=True)
+        for i in range(max(args.workers, 1))]
+    for w in workers:
+        w.start()
+
+    # Send the messages at the target rate
+    names = ["load%d" % i for i in range(args.agents)]
+    tags, weights = zip(*mix)
+    total = int(args.rate * args.duration)
+    begin = time.time()
+
+    for i in range(total):
+        delay = begin + i / args.rate - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        tag = rand.choices(tags, weights)[0]
+        msg = "dst=zam&tag=%s&name=%s" % (tag, rand.choice(names))
+        if rand.random() >= args.no_sender:
+            msg += "&sender=admin&src=jabber"
+
+        bus.send(msg)
+
+    bus.queue.join()
+    elapsed = time.time() - begin
+
+    for w in workers:
+        bus.queue.put((0, None))
+
+    # Report
+    print("zam import: %.3fs" % import_time)
+    print("%d messages in %.1fs (%.2f/s handled), %d outgoing" % (
+        sum(len(s["latency"]) for s in stats.values()), elapsed,
+        sum(len(s["latency"]) for s in stats.values()) / elapsed,
+        bus.outgoing))
+    print()
+    print("%-11s %6s %6s %9s %9s %9s %9s %9s" % ("tag", "count", "errors",
+        "delay50", "delay99", "lat50", "lat99", "latmax"))
+
+    for tag in sorted(stats):
+        st = stats[tag]
+        print("%-11s %6d %6d %8.3fs %8.3fs %8.3fs %8.3fs %8.3fs" % (tag,
+            len(st["latency"]), st["errors"],
+            percentile(st["delay"], 50), percentile(st["delay"], 99),
+            percentile(st["latency"], 50), percentile(st["latency"], 99),
+            max(st["latency"])))
+
+    count = sum(len(s["latency"]) for s in stats.values())
+    failed = sum(s["errors"] for s in stats.values())
+    print()
+    print("error rate: %.1f%%" % (100.0 * failed / max(count, 1)))
+
+    for error in errors[:5]:
+        print()
+        print(error)
+
+    problems = check_consistency(home, zam.ZAM_RESERVED)
+    print()
+    print("consistency: %s" % ("OK" if not problems else
+        "%d problems" % len(problems)))
+    for problem in problems:
+        print("  " + problem)
+
+    # Stop the agents that are still running
+    var = path(home, "var")
+    for pid_file in [f for f in os.listdir(var) if f.endswith(".pid")]:
+        try:
+            with open(path(var, pid_file)) as pfile:
+                os.kill(int(pfile.read()), 15)
+        except (OSError, ValueError):
+            pass
+
+    if args.keep:
+        print()
+        print("ZOE_HOME kept in %s" % home)
+    else:
+        shutil.rmtree(root, ignore_errors=True)
+
+    return 1 if failed or problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())